@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def load_monitor():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'openvpn-monitor.py')
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source('openvpn_monitor', path)
+    spec = spec_from_file_location('openvpn_monitor', path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def remote_address(i, ipv6_ratio):
+    if ipv6_ratio and i % int(1 / ipv6_ratio) == 0:
+        return '2001:db8:{0:x}::{1:x}'.format(i >> 16, i & 0xffff)
+    return '{0!s}.{1!s}.{2!s}.{3!s}:{4!s}'.format(
+        1 + (i >> 24) % 223, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff,
+        1024 + i % 60000)
+
+
+def status3_dump(nsessions, ipv6_ratio=0.0, layout='2.4'):
+    """Return a synthetic 'status 3' reply, END line included."""
+    since = 1470000000
+    lines = ['TITLE\tOpenVPN 2.4.0 x86_64-pc-linux-gnu',
+             'TIME\tMon Aug  1 00:00:00 2016\t{0!s}'.format(since + 3600)]
+    if layout == '2.4':
+        lines.append('HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\t'
+                     'Virtual IPv6 Address\tBytes Received\tBytes Sent\tConnected Since\t'
+                     'Connected Since (time_t)\tUsername\tClient ID\tPeer ID')
+        row = ('CLIENT_LIST\tclient{0!s}\t{1!s}\t10.{2!s}.{3!s}.{4!s}\t\t{5!s}\t{6!s}\t'
+               'Mon Aug  1 00:00:00 2016\t{7!s}\tUNDEF\t{0!s}\t{0!s}')
+    else:
+        lines.append('HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\t'
+                     'Bytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)')
+        row = ('CLIENT_LIST\tclient{0!s}\t{1!s}\t10.{2!s}.{3!s}.{4!s}\t{5!s}\t{6!s}\t'
+               'Mon Aug  1 00:00:00 2016\t{7!s}')
+    for i in range(nsessions):
+        lines.append(row.format(i, remote_address(i, ipv6_ratio), (i >> 16) & 0xff,
+                                (i >> 8) & 0xff, i & 0xff, i * 1024, i * 4096, since + i))
+    lines.append('HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\t'
+                 'Last Ref\tLast Ref (time_t)')
+    for i in range(nsessions):
+        lines.append('ROUTING_TABLE\t10.{0!s}.{1!s}.{2!s}\tclient{3!s}\t{4!s}\t'
+                     'Mon Aug  1 01:00:00 2016\t{5!s}'.format(
+                         (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff, i,
+                         remote_address(i, ipv6_ratio), since + 3600))
+    lines.append('GLOBAL_STATS\tMax bcast/mcast queue length\t0')
+    lines.append('END')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def status1_dump(nsessions):
+    """Return a synthetic 'status 1' reply, END line included.
+
+    Addresses are IPv4 only, as the status 1 parser expects address:port.
+    """
+    lines = ['OpenVPN CLIENT LIST', 'Updated,Mon Aug  1 01:00:00 2016',
+             'Common Name,Real Address,Bytes Received,Bytes Sent,Connected Since']
+    for i in range(nsessions):
+        lines.append('client{0!s},{1!s},{2!s},{3!s},Mon Aug  1 00:00:00 2016'.format(
+            i, remote_address(i, 0), i * 1024, i * 4096))
+    lines.append('ROUTING TABLE')
+    lines.append('Virtual Address,Common Name,Real Address,Last Ref')
+    for i in range(nsessions):
+        lines.append('10.{0!s}.{1!s}.{2!s},client{3!s},{4!s},Mon Aug  1 01:00:00 2016'.format(
+            (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff, i, remote_address(i, 0)))
+    lines.append('GLOBAL STATS')
+    lines.append('Max bcast/mcast queue length,0')
+    lines.append('END')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class FakeManagementServer(object):
+    """A local stand-in for an OpenVPN management interface.
+
+    Answers version, state, load-stats, pid and status 1/3 from synthetic
+    dumps. latency is added before every reply, and replies are written in
+    chunk_size pieces chunk_delay seconds apart when chunk_size is set.
+    """
+
+    def __init__(self, nsessions, ipv6_ratio=0.0, layout='2.4', latency=0.0,
+                 chunk_size=0, chunk_delay=0.0, port=0):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        status1 = status1_dump(nsessions).encode('utf-8')
+        self.replies = {
+            'version': b'OpenVPN Version: OpenVPN 2.4.0 x86_64-pc-linux-gnu\r\n'
+                       b'Management Version: 1\r\nEND\r\n',
+            'state': b'1470000000,CONNECTED,SUCCESS,10.8.0.1,,,,\r\nEND\r\n',
+            'load-stats': 'SUCCESS: nclients={0!s},bytesin={1!s},bytesout={2!s}\r\n'.format(
+                nsessions, 1 << 40, 1 << 41).encode('utf-8'),
+            'pid': b'SUCCESS: pid=1\r\n',
+            # a plain status is the same as status 1
+            'status': status1,
+            'status 1': status1,
+            'status 3': status3_dump(nsessions, ipv6_ratio, layout).encode('utf-8'),
+        }
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, client):
+        try:
+            client.sendall(b">INFO:OpenVPN Management Interface Version 1 -- "
+                           b"type 'help' for more info\r\n")
+            for line in client.makefile('rb'):
+                command = line.decode('utf-8').strip()
+                if command in ('quit', 'exit'):
+                    break
+                reply = self.replies.get(command)
+                if reply is None:
+                    if command.startswith('bytecount') or command.startswith('state '):
+                        reply = b'SUCCESS: ok\r\n'
+                    else:
+                        reply = b"ERROR: unknown command, enter 'help' for more options\r\n"
+                self.send(client, reply)
+        except (OSError, socket.error):
+            pass
+        finally:
+            client.close()
+
+    def send(self, client, reply):
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.chunk_size:
+            client.sendall(reply)
+            return
+        for i in range(0, len(reply), self.chunk_size):
+            client.sendall(reply[i:i + self.chunk_size])
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+
+    def close(self):
+        self.sock.close()
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        func(*args)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, nsessions, elapsed):
+    print('{0:<24} {1:>8} sessions {2:>9.1f} ms {3:>12.0f} sessions/s'.format(
+        name, nsessions, elapsed * 1000, nsessions / elapsed if elapsed else 0))
+
+
+def peak_memory(func, *args):
+    """Return the most memory func allocated at once, in bytes, or None."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def legacy_parse_status(monitor, data):
+    """The status 3 parser from before iter_status, kept for comparison.
+
+    It splits the whole reply at once and builds a dict with address and
+    datetime objects per session. Like the current parser it makes no GeoIP
+    lookups. It only understands the OpenVPN 2.3 layout of status 3.
+    """
+    client_section = False
+    routes_section = False
+    sessions = {}
+    for line in data.splitlines():
+        if ',' in line:
+            parts = line.split(',')
+        else:
+            parts = line.split('\t')
+        if parts[0].startswith('GLOBAL'):
+            break
+        if parts[0] == 'HEADER':
+            client_section = parts[1] == 'CLIENT_LIST'
+            routes_section = parts[1] == 'ROUTING_TABLE'
+            continue
+        if client_section:
+            session = {}
+            local_ip = parts[3]
+            sessions[local_ip] = session
+            session['username'] = parts[1]
+            if parts[2].count(':') == 1:
+                remote_ip, port = parts[2].split(':')
+            else:
+                remote_ip = parts[2]
+                port = None
+            remote_ip_address = monitor.ip_address(remote_ip)
+            session['local_ip'] = monitor.ip_address(local_ip)
+            session['bytes_recv'] = int(parts[4])
+            session['bytes_sent'] = int(parts[5])
+            session['connected_since'] = monitor.get_date(parts[7], uts=True)
+            session['last_seen'] = session['connected_since']
+            session['location'] = 'Unknown'
+            if isinstance(remote_ip_address, monitor.IPv6Address) and \
+                    remote_ip_address.ipv4_mapped is not None:
+                session['remote_ip'] = remote_ip_address.ipv4_mapped
+            else:
+                session['remote_ip'] = remote_ip_address
+            session['port'] = int(port) if port else ''
+            if session['remote_ip'].is_private:
+                session['location'] = 'RFC1918'
+        elif routes_section and parts[1] in sessions:
+            sessions[parts[1]]['last_seen'] = monitor.get_date(parts[5], uts=True)
+    return sessions
+
+
+def bench_parse(monitor, nsessions, options):
+    status3 = status3_dump(nsessions, options.ipv6_ratio, options.layout).splitlines()
+    status1 = status1_dump(nsessions).splitlines()
+
+    def consume(lines):
+        for record in monitor.OpenvpnMonitor.iter_status(lines):
+            pass
+    report('parse (iter_status)', nsessions, best_of(options.repeat, consume, status3))
+    report('parse (status 3)', nsessions,
+           best_of(options.repeat, monitor.OpenvpnMonitor.parse_status, status3))
+    report('parse (status 1)', nsessions,
+           best_of(options.repeat, monitor.OpenvpnMonitor.parse_status, status1))
+
+    # the parser before iter_status, on the only layout it understands: the
+    # whole reply is read into one string first, where iter_status takes the
+    # lines as they come off the socket
+    reply = status3_dump(nsessions, options.ipv6_ratio, '2.3').encode('utf-8')
+
+    def read_all():
+        return legacy_parse_status(monitor, b''.join(
+            reply[i:i + 65536] for i in range(0, len(reply), 65536)).decode('utf-8'))
+
+    def stream():
+        return monitor.OpenvpnMonitor.parse_status(
+            line.decode('utf-8') for line in io.BytesIO(reply))
+    for name, func in (('parse (legacy, 2.3)', read_all), ('parse (stream, 2.3)', stream)):
+        report(name, nsessions, best_of(options.repeat, func))
+        peak = peak_memory(func)
+        if peak is not None:
+            print('{0:<24} {1:>8} sessions {2:>9.1f} MiB peak'.format(
+                name, nsessions, peak / 1048576))
+
+
+def bench_collect(monitor, nsessions, options):
+    server = FakeManagementServer(nsessions, options.ipv6_ratio, options.layout,
+                                  options.latency, options.chunk_size,
+                                  options.chunk_delay).start()
+    settings = {'geoip': 'off', 'deadline': '600',
+                'pipeline': 'True' if options.pipeline else 'False'}
+    vpns = {'VPN1': {'name': 'Bench VPN', 'host': '127.0.0.1', 'port': str(server.port)}}
+
+    def collect():
+        collected = monitor.OpenvpnMonitor(dict((key, dict(vpn)) for key, vpn in vpns.items()),
+                                           settings)
+        if not collected.vpns['VPN1'].get('socket_connected'):
+            raise RuntimeError(collected.vpns['VPN1'].get('error'))
+    try:
+        report('collect', nsessions, best_of(options.repeat, collect))
+    finally:
+        server.close()
+
+
+def bench_geoip(monitor, nsessions, options):
+    if not os.path.exists(options.geoip_data):
+        print('geoip: skipped, {0!s} does not exist'.format(options.geoip_data))
+        return
+    sessions = monitor.OpenvpnMonitor.parse_status(
+        status3_dump(nsessions, options.ipv6_ratio, options.layout).splitlines()).sessions()
+    resolver = monitor.GeoipResolver(options.geoip_data, cache_size=nsessions)
+
+    def locate(resolver):
+        for session in sessions:
+            session._geo = None
+        monitor.locate_sessions(sessions, resolver)
+
+    def cold():
+        locate(monitor.GeoipResolver(options.geoip_data, cache_size=nsessions))
+    report('geoip (cold)', nsessions, best_of(options.repeat, cold))
+    locate(resolver)
+    report('geoip (cached)', nsessions, best_of(options.repeat, locate, resolver))
+
+
+class Config(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class Collected(object):
+
+    def __init__(self, vpns, timestamp):
+        self.vpns = vpns
+        self.timestamp = timestamp
+
+
+def synthetic_vpns(monitor, nsessions):
+    sessions = monitor.OpenvpnMonitor.parse_status(status3_dump(nsessions).splitlines())
+    for session in sessions.sessions():
+        session._geo = monitor.UNKNOWN_LOCATION
+    state = monitor.OpenvpnMonitor.parse_state(
+        '1470000000,CONNECTED,SUCCESS,10.8.0.1,,,,\r\nEND')
+    stats = {'nclients': nsessions, 'bytesin': 1 << 40, 'bytesout': 1 << 41}
+    return {'VPN1': {'name': 'Bench VPN', 'host': 'localhost', 'port': '5555',
+                     'socket_connected': True, 'state': state, 'stats': stats,
+                     'sessions': sessions, 'version': 'OpenVPN 2.4.0'}}
+
+
+def bench_render(monitor, nsessions, options):
+    collected = Collected(synthetic_vpns(monitor, nsessions), time.time())
+    # a single page holding every session
+    cfg = Config({'maps': 'False', 'page_size': str(nsessions)})
+
+    def render():
+        monitor.OpenvpnHtmlPrinter(cfg, collected).html()
+
+    def cold():
+        monitor.OpenvpnHtmlPrinter.cell_cache = {}
+        render()
+    report('render (cold)', nsessions, best_of(options.repeat, cold))
+    report('render (cached cells)', nsessions, best_of(options.repeat, render))
+
+
+def import_time(code):
+    """Return the microseconds python -X importtime reports for code."""
+    output = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[1]
+    total = 0
+    for line in output.decode('utf-8').splitlines():
+        parts = line.split('|')
+        # top level imports only, their cumulative time covers the rest
+        if len(parts) == 3 and parts[0].startswith('import time:') and \
+                not parts[2].startswith('  ') and parts[1].strip().isdigit():
+            total += int(parts[1])
+    return total
+
+
+def bench_startup(monitor, nsessions, options):
+    if sys.version_info < (3, 7):
+        print('startup: skipped, -X importtime needs Python 3.7')
+        return
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openvpn-monitor.py')
+    # the module level of the script without running main(), a few more
+    # runs than usual as process startup is noisy
+    runs = max(options.repeat, 5)
+    baseline = min(import_time('import runpy') for i in range(runs))
+    imports = min(import_time('import runpy; runpy.run_path({0!r})'.format(path))
+                  for i in range(runs)) - baseline
+    print('{0:<24} {1:>9.1f} ms, budget {2:.1f} ms'.format(
+        'startup (imports)', imports / 1000, options.startup_budget))
+    if imports / 1000 > options.startup_budget:
+        sys.exit('startup: imports take longer than --startup-budget')
+
+
+BENCHMARKS = {
+    'collect': bench_collect,
+    'geoip': bench_geoip,
+    'parse': bench_parse,
+    'render': bench_render,
+    'startup': bench_startup,
+}
+
+# benchmarks that do not depend on the number of sessions
+SINGLE_RUN = ('startup',)
+
+
+def collect_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark openvpn-monitor against synthetic data')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help='Benchmarks to run: {0!s}'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('-n', '--sessions', type=str, default='100,10000,100000',
+                        help='Comma separated session counts')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per benchmark, the best is reported')
+    parser.add_argument('-g', '--geoip-data', type=str,
+                        default='/usr/share/GeoIP/GeoIPCity.dat',
+                        help='Path to GeoIPCity.dat')
+    parser.add_argument('--ipv6-ratio', type=float, default=0.0,
+                        help='Share of clients connecting over IPv6')
+    parser.add_argument('--layout', choices=('2.3', '2.4'), default='2.4',
+                        help='Status 3 columns of this OpenVPN version')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake server waits before each reply')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='Bytes per write of the fake server, 0 for one write')
+    parser.add_argument('--chunk-delay', type=float, default=0.0,
+                        help='Seconds between the writes of the fake server')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Collect with pipelined commands')
+    parser.add_argument('--startup-budget', type=float, default=40.0,
+                        help='Milliseconds the imports of the script may take, '
+                             'the startup benchmark fails above it')
+    parser.add_argument('--fake-server', type=int, metavar='PORT', default=None,
+                        help='Only run a fake management server on PORT with '
+                             'the first session count')
+    return parser
+
+
+def main():
+    bench_args = collect_args().parse_args()
+    monitor = load_monitor()
+    monitor.args = monitor.collect_args().parse_args(
+        ['--geoip-data', bench_args.geoip_data])
+    counts = [int(n) for n in bench_args.sessions.split(',')]
+    if bench_args.fake_server is not None:
+        server = FakeManagementServer(counts[0], bench_args.ipv6_ratio, bench_args.layout,
+                                      bench_args.latency, bench_args.chunk_size,
+                                      bench_args.chunk_delay, bench_args.fake_server)
+        print('Fake management server with {0!s} sessions on 127.0.0.1:{1!s}'.format(
+            counts[0], server.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.close()
+        return
+    for name in bench_args.benchmarks:
+        if name in SINGLE_RUN:
+            BENCHMARKS[name](monitor, None, bench_args)
+            continue
+        for nsessions in counts:
+            BENCHMARKS[name](monitor, nsessions, bench_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,27 +11,52 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 try:
-    import ConfigParser as configparser
+    import Queue as queue
 except ImportError:
-    import configparser
+    import queue
 
 try:
     from ipaddr import IPAddress as ip_address
-    from ipaddr import IPv6Address
+    from ipaddr import IPv4Address, IPv6Address
 except ImportError:
-    from ipaddress import ip_address, IPv6Address
+    from ipaddress import ip_address, IPv4Address, IPv6Address
 
 
+try:
+    from urlparse import parse_qs
+    from urllib import unquote, urlencode
+except ImportError:
+    from urllib.parse import parse_qs, unquote, urlencode
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+# modules only some modes need (GeoIP, humanize, sqlite3, urllib, http.server,
+# cProfile, pprint, tempfile) are imported where they are used, as a CGI
+# script pays for every import on every page view
+import binascii
+import hashlib
+import json
+import os
+import select
 import socket
+import stat
 import re
 import argparse
-import GeoIP
+from bisect import bisect_left
 import sys
-from uuid import uuid4
-from datetime import datetime
-from humanize import naturalsize
-from collections import OrderedDict
-from pprint import pformat
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 if sys.version_info[0] == 2:
     reload(sys)
@@ -53,6 +78,109 @@ def get_date(date_string, uts=False):
         return datetime.fromtimestamp(float(date_string))
 
 
+MONTHS = dict((name, number) for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
+
+class StatusCache(object):
+    """Conversions shared by the rows of one status dump.
+
+    Dates such as 'Mon Aug  1 00:00:00 2016' are converted with one mktime
+    per distinct hour instead of a strptime per row, and repeated dates and
+    common names are only converted or stored once.
+    """
+
+    def __init__(self):
+        self.hours = {}
+        self.dates = {}
+        self.names = {}
+
+    def timestamp(self, date_string):
+        timestamp = self.dates.get(date_string)
+        if timestamp is not None:
+            return timestamp
+        try:
+            weekday, month, day, clock, year = date_string.split()
+            hour, minute, second = clock.split(':')
+            key = (year, month, day, hour)
+            start = self.hours.get(key)
+            if start is None:
+                start = self.hours[key] = int(time.mktime(
+                    (int(year), MONTHS[month], int(day), int(hour), 0, 0, 0, 0, -1)))
+            timestamp = start + int(minute) * 60 + int(second)
+        except (KeyError, ValueError):
+            raise ValueError('{0!r} is not a status date'.format(date_string))
+        self.dates[date_string] = timestamp
+        return timestamp
+
+    def intern(self, name):
+        return self.names.setdefault(name, name)
+
+
+def naturalsize(value, binary=False):
+    # replaced by humanize's own on first use
+    global naturalsize
+    from humanize import naturalsize
+    return naturalsize(value, binary=binary)
+
+
+def format_bytes(count):
+    return '{0!s} ({1!s})'.format(count, naturalsize(count, binary=True))
+
+
+def format_rate(rate):
+    return '{0!s}/s'.format(naturalsize(rate, binary=True))
+
+
+# formatted minutes by their first second, most sessions share a few of them
+minute_cache = {}
+
+
+def format_time(timestamp):
+    timestamp = int(timestamp)
+    seconds = timestamp % 60
+    minute = minute_cache.get(timestamp - seconds)
+    if minute is None:
+        if len(minute_cache) >= 10000:
+            minute_cache.clear()
+        minute = minute_cache[timestamp - seconds] = datetime.fromtimestamp(
+            timestamp - seconds).strftime('%d/%m/%Y %H:%M')
+    return '{0!s}:{1:02d}'.format(minute, seconds)
+
+
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+IPV4_COMPATIBLE_PREFIX = b'\x00' * 12
+
+
+def pack_address(address):
+    try:
+        if ':' in address:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+            if packed.startswith(IPV4_MAPPED_PREFIX):
+                return packed[12:]
+            return packed
+        return socket.inet_pton(socket.AF_INET, address)
+    except socket.error:
+        raise ValueError('{0!r} does not appear to be an IPv4 or IPv6 address'.format(address))
+
+
+def format_address(packed):
+    """Return the text form of a packed address without building an object."""
+    if len(packed) == 4:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    if packed.startswith(IPV4_COMPATIBLE_PREFIX):
+        # inet_ntop would write these with a dotted quad
+        return str(unpack_address(packed))
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def unpack_address(packed):
+    value = int(binascii.hexlify(packed), 16)
+    if len(packed) == 4:
+        return IPv4Address(value)
+    return IPv6Address(value)
+
+
 def get_str(s):
     if sys.version_info[0] == 2 and s is not None:
         return s.decode('ISO-8859-1')
@@ -60,12 +188,335 @@ def get_str(s):
         return s
 
 
+UNKNOWN_LOCATION = ('Unknown', None, None, None, None)
+PRIVATE_LOCATION = ('RFC1918', None, None, None, None)
+
+
+def locate_address(packed, geoip):
+    """Return (location, city, country_name, longitude, latitude)."""
+    address = unpack_address(packed)
+    if address.is_private:
+        return PRIVATE_LOCATION
+    gir = geoip.lookup(str(address))
+    if gir is None:
+        return UNKNOWN_LOCATION
+    return (gir['country_code'], get_str(gir['city']) or '',
+            gir['country_name'], gir['longitude'], gir['latitude'])
+
+
+def locate_sessions(sessions, geoip):
+    """Locate sessions in one pass, resolving each remote address once."""
+    located = {}
+    for session in sessions:
+        if session._geo is None:
+            packed = session._remote_ip
+            geo = located.get(packed)
+            if geo is None:
+                geo = located[packed] = locate_address(packed, geoip)
+            session._geo = geo
+
+
+def locate_vpns(vpns, geoip):
+    """Locate the sessions of each VPN, timing the pass per VPN."""
+    for key, vpn in vpns.items():
+        if vpn.get('sessions'):
+            started = timings and time.time()
+            locate_sessions(vpn['sessions'].sessions(), geoip)
+            if timings:
+                timings.record(vpn['name'], 'geoip', started)
+
+
+def _geo_property(index):
+    return property(lambda self: self.geo[index])
+
+
+class Session(object):
+    """A client session with a read-only mapping view for the printers.
+
+    Timestamps are kept as seconds since the epoch and addresses in packed
+    form; datetime and address objects are only built when read. The
+    location is filled in by locate_sessions, or looked up on first read.
+    """
+
+    __slots__ = ('key', 'client_id', 'username', 'port', 'bytes_recv', 'bytes_sent',
+                 '_geo', '_local_ip', '_remote_ip', '_connected_since', '_last_seen')
+
+    fields = ('username', 'local_ip', 'remote_ip', 'port', 'location', 'city',
+              'country_name', 'longitude', 'latitude', 'bytes_recv',
+              'bytes_sent', 'connected_since', 'last_seen')
+
+    def __init__(self, username, remote_ip, port, bytes_recv, bytes_sent,
+                 connected_since, last_seen=None, local_ip=None, key=None,
+                 client_id=None):
+        # key identifies the session across polls: (common name, real
+        # address, connected since)
+        self.key = key
+        self.client_id = client_id
+        self.username = username
+        self.port = port
+        self.bytes_recv = bytes_recv
+        self.bytes_sent = bytes_sent
+        self._geo = None
+        self._remote_ip = pack_address(remote_ip)
+        self._local_ip = pack_address(local_ip) if local_ip else None
+        self._connected_since = connected_since
+        self._last_seen = last_seen
+
+    @property
+    def remote_ip(self):
+        return unpack_address(self._remote_ip)
+
+    @property
+    def local_ip(self):
+        if self._local_ip is None:
+            return ''
+        return unpack_address(self._local_ip)
+
+    @local_ip.setter
+    def local_ip(self, address):
+        self._local_ip = pack_address(address)
+
+    @property
+    def geo(self):
+        if self._geo is None:
+            started = timings and time.time()
+            self._geo = locate_address(self._remote_ip, get_geoip_resolver())
+            if timings:
+                # lazy lookups happen while rendering, so are charged to the
+                # VPN being rendered
+                timings.record(getattr(timing_scope, 'name', 'page'), 'geoip (lazy)',
+                               started)
+        return self._geo
+
+    location = _geo_property(0)
+    city = _geo_property(1)
+    country_name = _geo_property(2)
+    longitude = _geo_property(3)
+    latitude = _geo_property(4)
+
+    @property
+    def connected_since(self):
+        return datetime.fromtimestamp(self._connected_since)
+
+    @property
+    def last_seen(self):
+        if self._last_seen is None:
+            return None
+        return datetime.fromtimestamp(self._last_seen)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.fields else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.fields and getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.fields if key in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __repr__(self):
+        return 'Session({0!r})'.format(dict(self.items()))
+
+    def as_dict(self):
+        local_ip = format_address(self._local_ip) if self._local_ip else ''
+        return {'username': self.username, 'remote_ip': format_address(self._remote_ip),
+                'port': self.port, 'local_ip': local_ip,
+                'bytes_recv': self.bytes_recv, 'bytes_sent': self.bytes_sent,
+                'connected_since': self._connected_since, 'last_seen': self._last_seen,
+                'location': self.location, 'city': self.city,
+                'country_name': self.country_name, 'longitude': self.longitude,
+                'latitude': self.latitude}
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot, None) for slot in self.__slots__)
+
+    def copy(self):
+        session = Session.__new__(Session)
+        session.__setstate__(self.__getstate__())
+        return session
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+
+class VpnStatus(dict):
+    """The sessions of one VPN keyed by VPN address, plus 'Client' in client mode."""
+
+    __slots__ = ()
+
+    def sessions(self):
+        return [session for session in self.values() if isinstance(session, Session)]
+
+    def index(self):
+        return dict((session.key, session) for session in self.sessions())
+
+
+class SessionIndex(object):
+    """Sort orders of the sessions of one VPN, built once per collection.
+
+    Sessions are kept sorted by username, which also answers username prefix
+    filters with a binary search; the other orders are lists of positions
+    into that list.
+    """
+
+    orders = ('username', 'bytes', 'connected_since')
+    sort_keys = {
+        'bytes': lambda session: session.bytes_recv + session.bytes_sent,
+        'connected_since': lambda session: session._connected_since,
+    }
+    max_names = 10
+
+    def __init__(self, sessions):
+        self.sessions = sorted(sessions.index().values(), key=lambda session: (
+            session.username.lower(), session._connected_since))
+        self.usernames = [session.username.lower() for session in self.sessions]
+        self.positions = {}
+        for sort, sort_key in self.sort_keys.items():
+            self.positions[sort] = sorted(range(len(self.sessions)),
+                                          key=lambda i: sort_key(self.sessions[i]))
+        self._locations = None
+        self._by_id = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def page(self, sort='username', reverse=False, prefix='', offset=0, limit=100):
+        """Return the number of matching sessions and the requested page of them."""
+        start, end = 0, len(self.sessions)
+        if prefix:
+            prefix = prefix.lower()
+            start = bisect_left(self.usernames, prefix)
+            end = bisect_left(self.usernames, prefix + '\uffff', start)
+        total = end - start
+        if sort not in self.sort_keys:
+            positions = range(start, end)
+        elif total == len(self.sessions):
+            positions = self.positions[sort]
+        else:
+            sort_key = self.sort_keys[sort]
+            positions = sorted(range(start, end), key=lambda i: sort_key(self.sessions[i]))
+        if reverse:
+            high = max(0, total - offset)
+            selected = positions[max(0, high - limit):high][::-1]
+        else:
+            selected = positions[offset:offset + limit]
+        return total, [self.sessions[i] for i in selected]
+
+    def by_id(self):
+        """Return the sessions by session_id, built on first use."""
+        if self._by_id is None:
+            self._by_id = dict((session_id(session), session) for session in self.sessions)
+        return self._by_id
+
+    def locations(self):
+        """Return [((latitude, longitude), sessions, names)] with a few names each."""
+        if self._locations is None:
+            located = OrderedDict()
+            for session in self.sessions:
+                if session.latitude is None or session.longitude is None:
+                    continue
+                point = (session.latitude, session.longitude)
+                entry = located.get(point)
+                if entry is None:
+                    entry = located[point] = [0, []]
+                entry[0] += 1
+                if len(entry[1]) < self.max_names:
+                    entry[1].append('{0!s} - {1!s}'.format(session.username,
+                                                           session.remote_ip))
+            self._locations = [(point, count, names)
+                               for point, (count, names) in located.items()]
+        return self._locations
+
+
+def session_id(session):
+    """Return a short identifier of a session, safe to use in HTML."""
+    key = session.key or (session.username, session.port, session._connected_since)
+    return hashlib.md5('\0'.join('{0!s}'.format(part) for part in key).encode(
+        'utf-8')).hexdigest()[:16]
+
+
+def format_counters(session):
+    """Return the bytes in, bytes out and last seen cells of a session."""
+    if session._last_seen is not None:
+        last_seen = format_time(session._last_seen)
+    else:
+        last_seen = 'ERROR'
+    return (format_bytes(session.bytes_recv), format_bytes(session.bytes_sent), last_seen)
+
+
+def iter_sessions(vpns):
+    for key, vpn in vpns.items():
+        if vpn.get('sessions'):
+            for session in vpn['sessions'].sessions():
+                yield session
+
+
+def iter_servers(vpns):
+    """Yield (name, stats) of the VPNs answering, those of sites included."""
+    for key, vpn in vpns.items():
+        if not vpn.get('socket_connected'):
+            continue
+        if 'site' in vpn:
+            for remote in vpn['site']['vpns']:
+                if remote.get('connected') and 'nclients' in remote:
+                    yield '{0!s}/{1!s}'.format(vpn['name'], remote['name']), remote
+        elif 'stats' in vpn:
+            yield vpn['name'], vpn['stats']
+
+
+def vpn_totals(vpns):
+    totals = {'nclients': 0, 'bytesin': 0, 'bytesout': 0}
+    for name, stats in iter_servers(vpns):
+        for counter in totals:
+            totals[counter] += stats[counter]
+    return totals
+
+
+def import_configparser():
+    try:
+        import ConfigParser as configparser
+    except ImportError:
+        import configparser
+    return configparser
+
+
 class ConfigLoader(object):
+    """The settings and VPN sections of the config file.
+
+    The parsed file is cached by its mtime and size in a directory only this
+    user can write to, so that page views skip configparser until the file
+    changes.
+    """
+
+    # bumped whenever the cached layout of settings or vpns changes
+    cache_version = 1
 
     def __init__(self, config_file):
 
         self.settings = {}
         self.vpns = OrderedDict()
+        try:
+            key = self.cache_key(config_file)
+        except OSError:
+            key = None
+        if key is not None and self.load_cache(config_file, key):
+            return
+        configparser = import_configparser()
         config = configparser.RawConfigParser()
         contents = config.read(config_file)
 
@@ -79,6 +530,71 @@ class ConfigLoader(object):
             else:
                 self.parse_vpn_section(config, section)
 
+        if contents and key is not None:
+            self.save_cache(config_file, key)
+
+    @classmethod
+    def cache_key(cls, config_file):
+        info = os.stat(config_file)
+        # a newer script may read settings the cached one left out
+        script = os.stat(os.path.abspath(__file__))
+        return (cls.cache_version, info.st_mtime, info.st_size, script.st_mtime)
+
+    @staticmethod
+    def cache_path(config_file):
+        """Return the cache file of config_file, or None if there is no safe place."""
+        if not hasattr(os, 'getuid'):
+            return None
+        directory = os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                                 'openvpn-monitor-{0!s}'.format(os.getuid()))
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError:
+            pass
+        try:
+            info = os.lstat(directory)
+        except OSError:
+            return None
+        # a directory prepared by another user could hold anything
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+                info.st_mode & 0o077:
+            return None
+        name = hashlib.md5(os.path.abspath(config_file).encode('utf-8')).hexdigest()
+        return os.path.join(directory, 'config-' + name)
+
+    def load_cache(self, config_file, key):
+        path = self.cache_path(config_file)
+        if path is None:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                cached = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if not isinstance(cached, tuple) or len(cached) != 3 or cached[0] != key:
+            return False
+        self.settings, self.vpns = cached[1], cached[2]
+        if args.debug:
+            debug("=== config {0!s} from {1!s}".format(config_file, path))
+        return True
+
+    def save_cache(self, config_file, key):
+        path = self.cache_path(config_file)
+        if path is None:
+            return
+        import tempfile
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.config-')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, self.settings, self.vpns), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            os.unlink(tmp_path)
+            warning('Unable to cache config in {0!s}: {1!s}'.format(path, e))
+
     def load_default_settings(self):
         warning('Using default settings => localhost:5555')
         self.settings = {'site': 'Default Site'}
@@ -86,7 +602,14 @@ class ConfigLoader(object):
                                     'port': '5555', 'order': '1'}
 
     def parse_global_section(self, config):
-        global_vars = ['site', 'logo', 'latitude', 'longitude', 'maps']
+        configparser = import_configparser()
+        global_vars = ['site', 'logo', 'latitude', 'longitude', 'maps',
+                       'concurrency', 'deadline', 'snapshot', 'interval',
+                       'persistent', 'pipeline', 'push', 'bytecount', 'reconcile',
+                       'geoip', 'geoip_cache_size',
+                       'geoip_cache_ttl', 'history', 'metrics_max_sessions',
+                       'page_size', 'max_interval', 'max_failures',
+                       'session_log', 'session_log_months']
         for var in global_vars:
             try:
                 self.settings[var] = config.get('OpenVPN-Monitor', var)
@@ -96,6 +619,7 @@ class ConfigLoader(object):
             debug("=== begin section\n{0!s}\n=== end section".format(self.settings))
 
     def parse_vpn_section(self, config, section):
+        configparser = import_configparser()
         self.vpns[section] = {}
         vpn = self.vpns[section]
         options = config.options(section)
@@ -111,68 +635,709 @@ class ConfigLoader(object):
             debug("=== begin section\n{0!s}\n=== end section".format(vpn))
 
 
-class OpenvpnMonitor(object):
+class GeoipResolver(object):
+
+    def __init__(self, path, cache_size=10000, cache_ttl=3600):
+        # path is None when locations are switched off
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.gi = None
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def _database(self, now):
+        # stat the database at most once a second and reopen it when replaced
+        if now - self.checked < 1:
+            return self.gi
+        first_check = not self.checked
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            if first_check or self.mtime is not None:
+                warning('GeoIP database unavailable: {0!s}'.format(e))
+            self.gi = None
+            self.mtime = None
+            return None
+        if mtime != self.mtime:
+            import GeoIP
+            mode = getattr(GeoIP, 'GEOIP_MMAP_CACHE', GeoIP.GEOIP_MEMORY_CACHE)
+            self.gi = GeoIP.open(self.path, mode)
+            self.mtime = mtime
+            self.cache.clear()
+        return self.gi
+
+    def lookup(self, address):
+        now = time.time()
+        if self.path is None:
+            return None
+        with self.lock:
+            gi = self._database(now)
+            if gi is None:
+                return None
+            entry = self.cache.pop(address, None)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                self.cache[address] = entry
+                return entry[1]
+            self.misses += 1
+            try:
+                record = gi.record_by_addr(address)
+            except SystemError:
+                record = None
+            self.cache[address] = (now + self.cache_ttl, record)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return record
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.cache)}
+
+
+geoip_resolver = None
+
+
+def get_geoip_resolver(settings=None):
+    global geoip_resolver
+    if geoip_resolver is None:
+        if settings is None:
+            settings = {}
+        path = args.geoip_data
+        if settings.get('geoip') == 'off':
+            path = None
+        geoip_resolver = GeoipResolver(
+            path, int(settings.get('geoip_cache_size', 10000)),
+            float(settings.get('geoip_cache_ttl', 3600)))
+    return geoip_resolver
+
+
+class Timings(object):
+    """Durations of the hot paths, by VPN (or 'page') and phase.
+
+    Only the last size samples of every phase are kept. Call sites check the
+    module global timings first, so nothing is measured unless profiling.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, phase, started):
+        elapsed = time.time() - started
+        with self.lock:
+            samples = self.samples.get((name, phase))
+            if samples is None:
+                samples = self.samples[(name, phase)] = deque(maxlen=self.size)
+            samples.append(elapsed)
+
+    def report(self):
+        """Return [(name, phase, count, min, avg, p95)], times in seconds."""
+        with self.lock:
+            items = [(key, sorted(samples)) for key, samples in self.samples.items()]
+        report = []
+        for (name, phase), samples in sorted(items):
+            report.append((name, phase, len(samples), samples[0],
+                           sum(samples) / len(samples),
+                           samples[(95 * len(samples) + 99) // 100 - 1]))
+        return report
+
+    def format(self):
+        lines = ['{0:<24} {1:<14} {2:>6} {3:>10} {4:>10} {5:>10}'.format(
+            'vpn', 'phase', 'count', 'min ms', 'avg ms', 'p95 ms')]
+        for name, phase, count, low, average, p95 in self.report():
+            lines.append('{0:<24} {1:<14} {2:>6} {3:>10.2f} {4:>10.2f} {5:>10.2f}'.format(
+                name, phase, count, low * 1000, average * 1000, p95 * 1000))
+        return '\n'.join(lines) + '\n'
+
+
+timings = None
+# name of the VPN being rendered by this thread, for lazy GeoIP timings
+timing_scope = threading.local()
+
+
+class ManagementSession(object):
+
+    single_line_commands = ('load-stats', 'pid', 'bytecount', 'state on', 'state off')
+    chunk_size = 65536
+    max_notifications = 100000
+
+    def __init__(self, host, port, timeout=3, deadline=None):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.last_used = time.time()
+        self.reused = False
+        self.buffer = bytearray()
+        self.pos = 0
+        # notifications in order, except byte counts, of which only the
+        # latest per client id is kept; overflowed is set when notifications
+        # had to be dropped, which calls for a full status
+        self.notifications = []
+        self.bytecounts = {}
+        self.overflowed = False
+        # push mode state, kept for the life of the connection
+        self.pushing = False
+        self.reconcile_at = 0
+        self.version = None
+        self.state = None
+        self.s = None
+
+    def _remaining(self):
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('deadline exceeded')
+        return min(self.timeout, remaining)
+
+    def connect(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.s = socket.create_connection((self.host, self.port), self._remaining())
+
+    def disconnect(self):
+        try:
+            self._socket_send('quit\n')
+        except socket.error:
+            pass
+        self.close()
 
-    def __init__(self, vpns):
-        self.vpns = vpns
-        for key, vpn in list(self.vpns.items()):
-            self._socket_connect(vpn)
-            if self.s:
-                self.collect_data(vpn)
-                self._socket_disconnect()
+    def close(self):
+        if self.s:
+            self.s.close()
+            self.s = None
 
-    def collect_data(self, vpn):
-        version = self.send_command('version\n')
-        vpn['version'] = self.parse_version(version)
-        state = self.send_command('state\n')
-        vpn['state'] = self.parse_state(state)
-        stats = self.send_command('load-stats\n')
-        vpn['stats'] = self.parse_stats(stats)
-        status = self.send_command('status 3\n')
-        vpn['sessions'] = self.parse_status(status)
+    def healthy(self):
+        try:
+            return self.send_command('pid\n').startswith('SUCCESS')
+        except socket.error:
+            return False
 
     def _socket_send(self, command):
+        self.s.settimeout(self._remaining())
         if sys.version_info[0] == 2:
             self.s.send(command)
         else:
             self.s.send(bytes(command, 'utf-8'))
 
-    def _socket_recv(self, length):
+    def _fill(self):
+        self.s.settimeout(self._remaining())
+        data = self.s.recv(self.chunk_size)
+        if not data:
+            raise socket.error('connection closed by {0!s}:{1!s}'.format(
+                self.host, self.port))
+        self.buffer += data
+
+    def _compact(self):
+        if self.pos == len(self.buffer):
+            del self.buffer[:]
+            self.pos = 0
+        elif self.pos > self.chunk_size:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    @staticmethod
+    def _decode(data):
         if sys.version_info[0] == 2:
-            return self.s.recv(length)
+            return bytes(data)
         else:
-            return self.s.recv(length).decode('utf-8')
-
-    def _socket_connect(self, vpn):
-        host = vpn['host']
-        port = int(vpn['port'])
-        timeout = 3
-        try:
-            self.s = socket.create_connection((host, port), timeout)
-            vpn['socket_connected'] = True
-        except socket.error:
-            self.s = False
-            vpn['socket_connected'] = False
-
-    def _socket_disconnect(self):
-        self._socket_send('quit\n')
-        self.s.close()
+            return data.decode('utf-8', 'replace')
 
-    def send_command(self, command):
+    def send_command(self, command, stream=False):
         self._socket_send(command)
-        data = ''
-        while 1:
-            socket_data = self._socket_recv(1024)
-            socket_data = re.sub('>INFO(.)*\r\n', '', socket_data)
-            data += socket_data
-            if command == 'load-stats\n' and data != '':
+        if stream:
+            return self.read_lines()
+        return self._read_reply(command.startswith(self.single_line_commands))
+
+    def send_commands(self, commands, stream=False):
+        self._socket_send(''.join(commands))
+        replies = [self._read_reply(command.startswith(self.single_line_commands))
+                   for command in commands[:-1]]
+        if stream:
+            replies.append(self.read_lines())
+        else:
+            replies.append(self._read_reply(
+                commands[-1].startswith(self.single_line_commands)))
+        return replies
+
+    def _first_line(self):
+        buf = self.buffer
+        # skip real-time notifications that arrive ahead of the reply
+        while True:
+            line_end = buf.find(b'\n', self.pos)
+            if line_end == -1:
+                self._fill()
+                continue
+            if buf[self.pos:self.pos + 1] != b'>':
+                return line_end
+            self._notify(self._decode(buf[self.pos:line_end]).rstrip('\r'))
+            self.pos = line_end + 1
+
+    def read_lines(self):
+        """Yield the lines of a multi-line reply as they arrive, without END."""
+        buf = self.buffer
+        line_end = self._first_line()
+        if buf.startswith(b'ERROR:', self.pos):
+            line = self._decode(buf[self.pos:line_end]).rstrip('\r')
+            self.pos = line_end + 1
+            self._compact()
+            yield line
+            return
+        while True:
+            if buf.startswith(b'END\r\n', self.pos):
+                self.pos += 5
+                self._compact()
+                return
+            found = buf.find(b'\nEND\r\n', self.pos)
+            if found != -1:
+                end = found + 1
+            else:
+                end = buf.rfind(b'\n', self.pos) + 1
+                if end == 0:
+                    self._fill()
+                    continue
+            block = self._decode(buf[self.pos:end])
+            self.pos = end
+            self._compact()
+            for line in block.splitlines():
+                if line.startswith('>'):
+                    self._notify(line)
+                else:
+                    yield line
+
+    def poll_notifications(self, max_chunks=256):
+        """Return and clear the notifications received so far, without blocking."""
+        for i in range(max_chunks):
+            if not select.select([self.s], [], [], 0)[0]:
                 break
-            elif data.endswith("\nEND\r\n"):
+            self._fill()
+        buf = self.buffer
+        while True:
+            line_end = buf.find(b'\n', self.pos)
+            if line_end == -1 or buf[self.pos:self.pos + 1] != b'>':
                 break
+            self._notify(self._decode(buf[self.pos:line_end]).rstrip('\r'))
+            self.pos = line_end + 1
+        self._compact()
+        # byte counts last, so that they also reach clients that just connected
+        notifications = self.notifications + list(self.bytecounts.values())
+        self.notifications = []
+        self.bytecounts = {}
+        return notifications
+
+    def _notify(self, line):
+        if line.startswith('>BYTECOUNT_CLI:'):
+            self.bytecounts[line[15:line.find(',', 15)]] = line
+        elif len(self.notifications) < self.max_notifications:
+            self.notifications.append(line)
+        else:
+            self.overflowed = True
+
+    def _read_reply(self, single_line):
+        buf = self.buffer
+        line_end = self._first_line()
+        if single_line or buf.startswith(b'ERROR:', self.pos):
+            end = line_end + 1
+        elif buf.startswith(b'END\r\n', self.pos):
+            end = self.pos + 5
+        else:
+            scan = line_end
+            while True:
+                found = buf.find(b'\nEND\r\n', scan)
+                if found != -1:
+                    end = found + 6
+                    break
+                scan = max(line_end, len(buf) - 5)
+                self._fill()
+        data = self._decode(buf[self.pos:end])
+        self.pos = end
+        self._compact()
+        if '\n>' in data:
+            lines = []
+            for line in data.splitlines(True):
+                if line.startswith('>'):
+                    self._notify(line.rstrip('\r\n'))
+                else:
+                    lines.append(line)
+            data = ''.join(lines)
         if args.debug:
             debug("=== begin raw data\n{0!s}\n=== end raw data".format(data))
         return data
 
+
+class ConnectionPool(object):
+
+    def __init__(self, persistent=False, timeout=3, health_interval=30, max_backoff=300):
+        self.persistent = persistent
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.max_backoff = max_backoff
+        self.sessions = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port, deadline, timeout=None):
+        """Return a connected session, one kept from an earlier poll if any.
+
+        timeout caps every connect, send and receive, self.timeout by default.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        key = (host, int(port))
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            failures, retry_at = self.failures.get(key, (0, 0))
+        if session is not None:
+            session.deadline = deadline
+            session.timeout = timeout
+            session.reused = True
+            idle = time.time() - session.last_used
+            if idle < self.health_interval or session.healthy():
+                return session
+            session.close()
+        if time.time() < retry_at:
+            raise socket.error('backing off for {0:.0f}s after {1!s} failures'.format(
+                retry_at - time.time(), failures))
+        session = ManagementSession(host, port, timeout, deadline)
+        try:
+            session.connect()
+        except socket.error:
+            if self.persistent:
+                backoff = min(self.max_backoff, 2 ** (failures + 1))
+                with self.lock:
+                    self.failures[key] = (failures + 1, time.time() + backoff)
+            raise
+        with self.lock:
+            self.failures.pop(key, None)
+        return session
+
+    def release(self, session):
+        if not self.persistent:
+            session.disconnect()
+            return
+        session.last_used = time.time()
+        with self.lock:
+            self.sessions[(session.host, session.port)] = session
+
+    def discard(self, session):
+        session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.disconnect()
+
+
+class OpenvpnMonitor(object):
+
+    def __init__(self, vpns, settings=None, pool=None, previous=None):
+        if settings is None:
+            settings = {}
+        if pool is None:
+            pool = ConnectionPool()
+        if previous is None:
+            previous = {}
+        self.vpns = vpns
+        self.pool = pool
+        self.previous = previous
+        self.concurrency = max(1, int(settings.get('concurrency', 10)))
+        self.deadline = float(settings.get('deadline', 10))
+        self.pipeline = settings.get('pipeline') == 'True'
+        self.push = settings.get('push') == 'True' and self.pool.persistent
+        self.bytecount = int(settings.get('bytecount', 5))
+        self.reconcile = float(settings.get('reconcile', 300))
+        self.geoip = get_geoip_resolver(settings)
+        self.collect_all()
+        if settings.get('geoip', 'batch') == 'batch':
+            locate_vpns(self.vpns, self.geoip)
+        self.timestamp = time.time()
+
+    def collect_all(self):
+        pending = queue.Queue()
+        for key, vpn in list(self.vpns.items()):
+            pending.put((key, vpn))
+        nworkers = min(self.concurrency, len(self.vpns))
+        if nworkers <= 1:
+            self._worker(pending)
+            return
+        workers = []
+        for i in range(nworkers):
+            worker = threading.Thread(target=self._worker, args=(pending,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+    def _worker(self, pending):
+        while True:
+            try:
+                key, vpn = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if 'url' in vpn:
+                    self.poll_site(vpn, self.previous.get(key))
+                else:
+                    self.poll_vpn(vpn, self.previous.get(key))
+            except Exception as e:
+                # one broken VPN must not take the others down with it
+                vpn['socket_connected'] = False
+                vpn['error'] = 'Collection failed ({0!s})'.format(e)
+                warning('Unable to poll {0!s}: {1!r}'.format(vpn['name'], e))
+
+    def poll_site(self, vpn, previous=None):
+        """Fetch the VPN list of another openvpn-monitor from its /api/vpns.
+
+        A site that does not answer within its timeout keeps the list of its
+        last successful poll, marked stale, so it never holds up the others.
+        """
+        try:
+            from urllib2 import HTTPError, Request, URLError, urlopen
+        except ImportError:
+            from urllib.error import HTTPError, URLError
+            from urllib.request import Request, urlopen
+        url = vpn['url'].rstrip('/') + '/api/vpns'
+        request = Request(url, headers={'Accept-Encoding': 'gzip'})
+        if previous is not None and previous.get('etag'):
+            request.add_header('If-None-Match', previous['etag'])
+        started = timings and time.time()
+        try:
+            response = urlopen(request, timeout=float(vpn.get('timeout', self.deadline)))
+            body = response.read()
+            if response.info().get('Content-Encoding') == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            site = json.loads(body.decode('utf-8'))
+            site['etag'] = response.info().get('ETag')
+        except HTTPError as e:
+            if e.code == 304 and previous is not None:
+                site = previous
+            else:
+                site = None
+                error = 'Site returned {0!s}'.format(e.code)
+        except (URLError, socket.error, ValueError) as e:
+            site = None
+            error = 'Site unavailable ({0!s})'.format(getattr(e, 'reason', e))
+        if timings:
+            timings.record(vpn['name'], 'site', started)
+        if site is None:
+            if args.debug:
+                debug("=== fetching {0!s} failed: {1!s}".format(url, error))
+            if previous is None:
+                vpn['socket_connected'] = False
+                vpn['error'] = error
+                return
+            site = previous
+            vpn['error'] = error
+            vpn['stale'] = True
+        vpn['socket_connected'] = True
+        vpn['site'] = site
+
+    def poll_vpn(self, vpn, previous=None):
+        # a VPN's own timeout is also allowed to every single read and write
+        timeout = float(vpn['timeout']) if 'timeout' in vpn else None
+        deadline = time.time() + (self.deadline if timeout is None else timeout)
+        while True:
+            started = timings and time.time()
+            try:
+                session = self.pool.acquire(vpn['host'], vpn['port'], deadline, timeout)
+                if timings:
+                    timings.record(vpn['name'], 'connect', started)
+            except socket.error as e:
+                vpn['socket_connected'] = False
+                vpn['error'] = 'Connection refused'
+                if args.debug:
+                    debug("=== connect to {0!s} failed: {1!s}".format(vpn['name'], e))
+                return
+            vpn['socket_connected'] = True
+            try:
+                self.collect_data(vpn, session, previous)
+            except socket.error as e:
+                self.pool.discard(session)
+                vpn['socket_connected'] = False
+                vpn['error'] = 'Connection failed ({0!s})'.format(e)
+                # a kept-alive session may have gone away between polls
+                if session.reused and time.time() < deadline:
+                    continue
+                return
+            except Exception as e:
+                # an unexpected reply leaves the connection in an unknown state
+                self.pool.discard(session)
+                vpn['socket_connected'] = False
+                vpn['error'] = 'Unexpected reply ({0!s})'.format(e)
+                warning('Unable to parse the replies of {0!s}: {1!r}'.format(vpn['name'], e))
+                if args.debug:
+                    import traceback
+                    debug(traceback.format_exc())
+                return
+            self.pool.release(session)
+            return
+
+    def collect_data(self, vpn, session, previous=None):
+        if self.push and session.pushing and previous is not None and \
+                time.time() < session.reconcile_at and not session.overflowed:
+            started = timings and time.time()
+            pushed = self.collect_pushed(vpn, session, previous)
+            if timings:
+                timings.record(vpn['name'], 'push', started)
+            if pushed:
+                return
+        if session.overflowed:
+            # connects or disconnects were lost, the status has them all
+            warning('Too many notifications from {0!s}, reading the full status'.format(
+                vpn['name']))
+            session.poll_notifications()
+            session.overflowed = False
+        commands = ['version\n', 'state\n', 'load-stats\n', 'status 3\n']
+        if self.pipeline:
+            started = timings and time.time()
+            replies = session.send_commands(commands, stream=True)
+            if timings:
+                timings.record(vpn['name'], 'commands', started)
+        else:
+            replies = []
+            for command in commands:
+                started = timings and time.time()
+                replies.append(session.send_command(command, stream=command == 'status 3\n'))
+                if timings:
+                    timings.record(vpn['name'], command.strip(), started)
+        version, state, stats, status = replies
+        vpn['version'] = self.parse_version(version)
+        vpn['state'] = self.parse_state(state)
+        vpn['stats'] = self.parse_stats(stats)
+        if previous is not None:
+            previous = previous.index()
+        # status 3 is streamed, so this includes reading it
+        started = timings and time.time()
+        vpn['sessions'] = self.parse_status(status, previous)
+        if timings:
+            timings.record(vpn['name'], 'parse_status', started)
+        if self.push:
+            self.enable_push(vpn, session)
+
+    def enable_push(self, vpn, session):
+        # notifications name clients by client id, which status only
+        # reports from OpenVPN 2.4
+        sessions = vpn['sessions'].sessions()
+        if vpn['state'].get('mode') != 'Server' or \
+                any(s.client_id is None for s in sessions):
+            session.pushing = False
+            return
+        if not session.pushing:
+            session.send_command('bytecount {0!s}\n'.format(self.bytecount))
+            session.send_command('state on\n')
+            session.pushing = True
+        session.version = vpn['version']
+        session.state = vpn['state']
+        session.reconcile_at = time.time() + self.reconcile
+
+    def collect_pushed(self, vpn, session, previous):
+        """Update vpn from the notifications since the last poll, or return
+        False when some of them were dropped."""
+        stats = session.send_command('load-stats\n')
+        notifications = session.poll_notifications()
+        if session.overflowed:
+            return False
+        vpn['version'] = session.version
+        vpn['stats'] = self.parse_stats(stats)
+        state, sessions = self.apply_notifications(session.state, previous, notifications)
+        vpn['state'] = session.state = state
+        vpn['sessions'] = sessions
+        return True
+
+    @staticmethod
+    def apply_notifications(state, sessions, notifications):
+        """Return the state and a new VpnStatus updated from real-time
+        notifications. Sessions are copied before they are changed."""
+        sessions = VpnStatus(sessions)
+        by_client_id = {}
+        keys = set()
+        for ident, session in sessions.items():
+            if isinstance(session, Session):
+                by_client_id[session.client_id] = ident
+                keys.add(session.key)
+        copied = set()
+        event = None
+        env = {}
+
+        def writable(ident):
+            if ident not in copied:
+                sessions[ident] = sessions[ident].copy()
+                copied.add(ident)
+            return sessions[ident]
+
+        for line in notifications:
+            if line.startswith('>BYTECOUNT_CLI:'):
+                client_id, bytes_recv, bytes_sent = line[15:].split(',')
+                ident = by_client_id.get(client_id)
+                if ident is None:
+                    continue
+                bytes_recv = int(bytes_recv)
+                bytes_sent = int(bytes_sent)
+                session = sessions[ident]
+                # counters only grow, so ignore counts older than the last status
+                if bytes_recv > session.bytes_recv or bytes_sent > session.bytes_sent:
+                    session = writable(ident)
+                    session.bytes_recv = max(bytes_recv, session.bytes_recv)
+                    session.bytes_sent = max(bytes_sent, session.bytes_sent)
+                    session._last_seen = int(time.time())
+            elif line.startswith('>CLIENT:ESTABLISHED,') or \
+                    line.startswith('>CLIENT:DISCONNECT,'):
+                event, client_id = line[8:].split(',')[:2]
+                event = (event, client_id)
+                env = {}
+            elif line.startswith('>CLIENT:ENV,') and event is not None:
+                if line != '>CLIENT:ENV,END':
+                    name, _, value = line[12:].partition('=')
+                    env[name] = value
+                    continue
+                kind, client_id = event
+                event = None
+                if kind == 'DISCONNECT':
+                    ident = by_client_id.pop(client_id, None)
+                    if ident is not None:
+                        del sessions[ident]
+                    continue
+                session = OpenvpnMonitor._established_session(client_id, env)
+                # a connect buffered during a full status is already in it,
+                # with counters that must not start again from zero
+                if session is not None and client_id not in by_client_id and \
+                        session.key not in keys:
+                    ident = env.get('ifconfig_pool_remote_ip') or session.key[1]
+                    sessions[ident] = session
+                    by_client_id[client_id] = ident
+                    keys.add(session.key)
+                    copied.add(ident)
+            elif line.startswith('>STATE:'):
+                state = OpenvpnMonitor.parse_state(line[7:])
+        return state, sessions
+
+    @staticmethod
+    def _established_session(client_id, env):
+        remote_ip = env.get('trusted_ip') or env.get('untrusted_ip')
+        port = env.get('trusted_port') or env.get('untrusted_port')
+        if not remote_ip or 'common_name' not in env:
+            return None
+        if ':' in remote_ip:
+            remote = remote_ip
+        else:
+            remote = '{0!s}:{1!s}'.format(remote_ip, port)
+        connected_since = int(env.get('time_unix', time.time()))
+        return Session(env['common_name'], remote_ip, int(port) if port else '', 0, 0,
+                       connected_since, last_seen=connected_since,
+                       local_ip=env.get('ifconfig_pool_remote_ip'),
+                       key=(env['common_name'], remote, connected_since),
+                       client_id=client_id)
+
     @staticmethod
     def parse_state(data):
         state = {}
@@ -213,140 +1378,177 @@ class OpenvpnMonitor(object):
 
         return stats
 
+    client_stats = {
+        'TUN/TAP read bytes': 'tuntap_read',
+        'TUN/TAP write bytes': 'tuntap_write',
+        'TCP/UDP read bytes': 'tcpudp_read',
+        'TCP/UDP write bytes': 'tcpudp_write',
+        'Auth read bytes': 'auth_read',
+    }
+
+    # status 3 columns by name, with the OpenVPN 2.3 positions as fallback
+    client_list_columns = (('Common Name', 1), ('Real Address', 2),
+                           ('Virtual Address', 3), ('Bytes Received', 4),
+                           ('Bytes Sent', 5), ('Connected Since (time_t)', 7),
+                           ('Client ID', None))
+    routing_table_columns = (('Virtual Address', 1), ('Last Ref (time_t)', 5))
+
+    @staticmethod
+    def parse_status(data, previous=None):
+        """Parse a status reply into a VpnStatus.
+
+        previous maps session keys to the sessions of the last poll of the
+        same VPN. Those sessions are reused when unchanged and copied when
+        their counters moved, so they are never modified in place.
+        """
+        if isinstance(data, (type(''), type(b''))):
+            data = data.splitlines()
+        if previous is None:
+            previous = {}
+        sessions = VpnStatus()
+
+        for kind, ident, record in OpenvpnMonitor.iter_status(data, previous):
+            if kind == 'session':
+                sessions[ident] = record
+            elif kind == 'route':
+                session = sessions.get(ident)
+                if session is not None:
+                    last_seen, local_ip = record
+                    if session._last_seen != last_seen:
+                        if previous.get(session.key) is session:
+                            session = sessions[ident] = session.copy()
+                        session._last_seen = last_seen
+                    if local_ip and session._local_ip is None:
+                        session.local_ip = local_ip
+            elif kind == 'client':
+                sessions['Client'] = record
+
+        if args.debug:
+            from pprint import pformat
+            if sessions:
+                pretty_sessions = pformat(sessions)
+                debug("=== begin sessions\n{0!s}\n=== end sessions".format(pretty_sessions))
+            else:
+                debug("no sessions")
+
+        return sessions
+
     @staticmethod
-    def parse_status(data):
-        client_section = False
-        routes_section = False
-        status_version = 1
-        sessions = {}
+    def iter_status(lines, previous=None):
+        """Yield ('session', ident, session), ('route', ident, (last_seen,
+        local_ip)) and ('client', 'Client', stats) records from status 1 or
+        status 3 lines.
+
+        The iterable is always consumed to the end so that a streaming
+        reader is left at the start of the next reply.
+        """
+        client_stats = OpenvpnMonitor.client_stats
         client_session = {}
-        gi = GeoIP.open(args.geoip_data, GeoIP.GEOIP_STANDARD)
+        cache = StatusCache()
+        section = None
+        client_columns = tuple(i for name, i in OpenvpnMonitor.client_list_columns)
+        route_columns = tuple(i for name, i in OpenvpnMonitor.routing_table_columns)
 
-        for line in data.splitlines():
+        for line in lines:
+            if section == 'done':
+                continue
 
-            if ',' in line:
-                parts = line.split(',')
-            else:
+            if '\t' in line:
                 parts = line.split('\t')
+            else:
+                parts = line.split(',')
+            kind = parts[0]
 
             if args.debug:
                 debug("=== begin split line\n{0!s}\n=== end split line".format(parts))
 
-            if parts[0].startswith('GLOBAL'):
-                break
-            if parts[0] == 'HEADER':
-                status_version = 3
-                if parts[1] == 'CLIENT_LIST':
-                    client_section = True
-                    routes_section = False
-                if parts[1] == 'ROUTING_TABLE':
-                    client_section = False
-                    routes_section = True
+            # status 3: every row is tagged, so dispatch on the tag alone
+            if kind == 'CLIENT_LIST':
+                yield OpenvpnMonitor._client_list_row(parts, client_columns, previous, cache)
                 continue
-            if parts[0] == 'Updated':
+            if kind == 'ROUTING_TABLE':
+                ident = parts[route_columns[0]]
+                yield 'route', ident, (int(parts[route_columns[1]]), None)
                 continue
-            if parts[0] == 'Common Name':
-                status_version = 1
-                client_section = True
-                routes_section = False
+            if kind == 'HEADER':
+                names = dict((name, i) for i, name in enumerate(parts[1:]))
+                if parts[1] == 'CLIENT_LIST':
+                    client_columns = tuple(names.get(name, i) for name, i
+                                           in OpenvpnMonitor.client_list_columns)
+                elif parts[1] == 'ROUTING_TABLE':
+                    route_columns = tuple(names.get(name, i) for name, i
+                                          in OpenvpnMonitor.routing_table_columns)
                 continue
-            if parts[0] == 'ROUTING TABLE' or parts[0] == 'Virtual Address':
-                status_version = 1
-                client_section = False
-                routes_section = True
+            if kind.startswith('GLOBAL'):
+                section = 'done'
                 continue
-            if parts[0].startswith('>CLIENT'):
+            if kind in client_stats:
+                client_session[client_stats[kind]] = int(parts[1])
+                if kind == 'Auth read bytes':
+                    yield 'client', 'Client', client_session
                 continue
 
-            session = {}
-            if parts[0] == 'TUN/TAP read bytes':
-                client_session['tuntap_read'] = int(parts[1])
-                continue
-            if parts[0] == 'TUN/TAP write bytes':
-                client_session['tuntap_write'] = int(parts[1])
-                continue
-            if parts[0] == 'TCP/UDP read bytes':
-                client_session['tcpudp_read'] = int(parts[1])
-                continue
-            if parts[0] == 'TCP/UDP write bytes':
-                client_session['tcpudp_write'] = int(parts[1])
+            # status 1: sections are introduced by title rows
+            if kind == 'Common Name':
+                section = 'clients'
+            elif kind == 'ROUTING TABLE' or kind == 'Virtual Address':
+                section = 'routes'
+            elif kind == 'Updated' or kind.startswith('>CLIENT'):
                 continue
-            if parts[0] == 'Auth read bytes':
-                client_session['auth_read'] = int(parts[1])
-                sessions['Client'] = client_session
-                continue
-            if client_section and not routes_section:
-                if status_version == 1:
-                    ident = parts[1]
-                    sessions[ident] = session
-                    session['username'] = parts[0]
-                    remote_ip, port = parts[1].split(':')
-                    session['bytes_recv'] = int(parts[2])
-                    session['bytes_sent'] = int(parts[3])
-                    session['connected_since'] = get_date(parts[4])
-                elif status_version == 3:
-                    local_ip = parts[3]
-                    if local_ip:
-                        ident = local_ip
-                    else:
-                        ident = str(uuid4())
-                    sessions[ident] = session
-                    session['username'] = parts[1]
-                    if parts[2].count(':') == 1:
-                        remote_ip, port = parts[2].split(':')
-                    else:
-                        remote_ip = parts[2]
-                        port = None
-                    remote_ip_address = ip_address(remote_ip)
-                    if local_ip:
-                        session['local_ip'] = ip_address(local_ip)
-                    else:
-                        session['local_ip'] = ''
-                    session['bytes_recv'] = int(parts[4])
-                    session['bytes_sent'] = int(parts[5])
-                    session['connected_since'] = get_date(parts[7], uts=True)
-                    session['last_seen'] = session['connected_since']
-                session['location'] = 'Unknown'
-                if isinstance(remote_ip_address, IPv6Address) and \
-                        remote_ip_address.ipv4_mapped is not None:
-                    session['remote_ip'] = remote_ip_address.ipv4_mapped
-                else:
-                    session['remote_ip'] = remote_ip_address
-                if port:
-                    session['port'] = int(port)
-                else:
-                    session['port'] = ''
-                if session['remote_ip'].is_private:
-                    session['location'] = 'RFC1918'
-                else:
-                    try:
-                        gir = gi.record_by_addr(str(session['remote_ip']))
-                    except SystemError:
-                        gir = None
-                    if gir is not None:
-                        session['location'] = gir['country_code']
-                        session['city'] = get_str(gir['city'])
-                        session['country_name'] = gir['country_name']
-                        session['longitude'] = gir['longitude']
-                        session['latitude'] = gir['latitude']
-            if routes_section and not client_section:
-                if status_version == 1:
-                    ident = parts[2]
-                    sessions[ident]['local_ip'] = ip_address(parts[0])
-                    sessions[ident]['last_seen'] = get_date(parts[3])
-                elif status_version == 3:
-                    local_ip = parts[1]
-                    if local_ip in sessions:
-                        sessions[local_ip]['last_seen'] = get_date(parts[5], uts=True)
+            elif section == 'clients':
+                yield OpenvpnMonitor._status1_client_row(parts, previous, cache)
+            elif section == 'routes':
+                yield 'route', parts[2], (cache.timestamp(parts[3]), parts[0])
 
-        if args.debug:
-            if sessions:
-                pretty_sessions = pformat(sessions)
-                debug("=== begin sessions\n{0!s}\n=== end sessions".format(pretty_sessions))
-            else:
-                debug("no sessions")
+    @staticmethod
+    def _reuse(previous, key, bytes_recv, bytes_sent):
+        session = previous.get(key)
+        if session is not None and (session.bytes_recv != bytes_recv or
+                                    session.bytes_sent != bytes_sent):
+            session = session.copy()
+            session.bytes_recv = bytes_recv
+            session.bytes_sent = bytes_sent
+        return session
 
-        return sessions
+    @staticmethod
+    def _client_list_row(parts, columns, previous, cache):
+        name, real_address, virtual_address, recv, sent, since, client_id = columns
+        remote = parts[real_address]
+        local_ip = parts[virtual_address]
+        # sessions without a VPN address are keyed by their real address
+        ident = local_ip or remote
+        username = cache.intern(parts[name])
+        key = (username, remote, int(parts[since]))
+        bytes_recv = int(parts[recv])
+        bytes_sent = int(parts[sent])
+        if previous:
+            session = OpenvpnMonitor._reuse(previous, key, bytes_recv, bytes_sent)
+            if session is not None:
+                return 'session', ident, session
+        if remote.count(':') == 1:
+            remote_ip, port = remote.split(':')
+            port = int(port)
+        else:
+            remote_ip = remote
+            port = ''
+        session = Session(username, remote_ip, port, bytes_recv, bytes_sent,
+                          key[2], last_seen=key[2], local_ip=local_ip, key=key,
+                          client_id=parts[client_id] if client_id else None)
+        return 'session', ident, session
+
+    @staticmethod
+    def _status1_client_row(parts, previous, cache):
+        key = (cache.intern(parts[0]), parts[1], cache.timestamp(parts[4]))
+        bytes_recv = int(parts[2])
+        bytes_sent = int(parts[3])
+        if previous:
+            session = OpenvpnMonitor._reuse(previous, key, bytes_recv, bytes_sent)
+            if session is not None:
+                return 'session', parts[1], session
+        remote_ip, port = parts[1].split(':')
+        session = Session(key[0], remote_ip, int(port), bytes_recv, bytes_sent,
+                          key[2], key=key)
+        return 'session', parts[1], session
 
     @staticmethod
     def parse_version(data):
@@ -355,24 +1557,762 @@ class OpenvpnMonitor(object):
                 return line.replace('OpenVPN Version: ', '')
 
 
-class OpenvpnHtmlPrinter(object):
+class Snapshot(object):
 
-    def __init__(self, cfg, monitor):
+    # bumped whenever the pickled layout of vpns or Session changes
+    version = 5
+
+    def __init__(self, vpns, generation=0, timestamp=None, events=None):
+        self.vpns = vpns
+        self.generation = generation
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+        self.events = events or []
+
+    def save(self, path):
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # a small header first, so that peek() need not read the rest
+                pickle.dump({'version': self.version,
+                             'generation': self.generation,
+                             'timestamp': self.timestamp}, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump({'vpns': self.vpns,
+                             'events': self.events}, f, pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def peek(cls, path):
+        """Return (generation, timestamp) of the snapshot at path, or None."""
+        try:
+            with open(path, 'rb') as f:
+                header = pickle.load(f)
+        except Exception:
+            return None
+        if not isinstance(header, dict) or header.get('version') != cls.version:
+            return None
+        return header['generation'], header['timestamp']
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                header = pickle.load(f)
+                if not isinstance(header, dict) or header.get('version') != cls.version:
+                    warning('Ignoring snapshot {0!s} from another version'.format(path))
+                    return None
+                data = pickle.load(f)
+        except Exception as e:
+            # anything unpickling can raise, such as ImportError for a
+            # snapshot pickled by another Python version
+            warning('Unable to read snapshot {0!s}: {1!s}'.format(path, e))
+            return None
+        return cls(data['vpns'], header['generation'], header['timestamp'],
+                   data.get('events'))
+
+
+def connect_sqlite(path, readonly=False):
+    """Open the SQLite database at path, without ever creating it when readonly.
+
+    Python 2 cannot open a database read-only, so readers check that the file
+    exists first there.
+    """
+    import sqlite3
+    if readonly and sys.version_info[0] > 2:
+        from urllib.request import pathname2url
+        return sqlite3.connect('file:{0!s}?mode=ro'.format(
+            pathname2url(os.path.abspath(path))), uri=True, check_same_thread=False)
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+class TrafficHistory(object):
+    """Traffic of each VPN and each user, summed into fixed time buckets.
+
+    Series are named 'vpn:<key>' and 'user:<key>:<username>'. Every tier is a
+    (bucket seconds, seconds kept) pair. Open buckets live in memory, along with
+    the last ring_size minutes of every VPN; closed buckets are added to the
+    SQLite database at path, when one is given, and expired per tier. Series
+    of users are only kept in that database.
+    """
+
+    tiers = ((60, 2 * 86400), (3600, 90 * 86400))
+    ring_size = 60
+
+    def __init__(self, path=None, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        # VPNs are polled on their own schedules, so everything is kept by VPN
+        # key: the time of the last poll and the cumulative counters of the
+        # server and of each session
+        self.last_polls = {}
+        self.server_counters = {}
+        self.session_counters = {}
+        # (series, resolution) -> [bucket, bytes_in, bytes_out]
+        self.open = {}
+        self.rings = {}
+        self.db = None
+        if path and readonly:
+            self.db = connect_sqlite(path, readonly=True)
+        elif path:
+            self.db = connect_sqlite(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS traffic ('
+                            'series TEXT NOT NULL, resolution INTEGER NOT NULL, '
+                            'ts INTEGER NOT NULL, bytes_in INTEGER NOT NULL, '
+                            'bytes_out INTEGER NOT NULL, '
+                            'PRIMARY KEY (series, resolution, ts))')
+            self.db.commit()
+
+    @staticmethod
+    def delta(previous, current):
+        # counters start again from zero when a server restarts
+        if current < previous:
+            return current
+        return current - previous
+
+    def record(self, timestamp, vpns):
+        """Add the counters of a poll, setting vpn['rates'] in bytes/s."""
+        closed = []
+        with self.lock:
+            self._close_buckets(timestamp, closed)
+            for key, vpn in vpns.items():
+                if not vpn.get('socket_connected') or 'stats' not in vpn or \
+                        vpn.get('stale'):
+                    continue
+                last_poll = self.last_polls.get(key)
+                stats = vpn['stats']
+                counters = (stats['bytesin'], stats['bytesout'])
+                previous = self.server_counters.get(key)
+                self.server_counters[key] = counters
+                if previous is not None:
+                    bytes_in = self.delta(previous[0], counters[0])
+                    bytes_out = self.delta(previous[1], counters[1])
+                    self._add(timestamp, 'vpn:' + key, bytes_in, bytes_out)
+                    elapsed = timestamp - last_poll
+                    if elapsed > 0:
+                        vpn['rates'] = (bytes_in / elapsed, bytes_out / elapsed)
+                self.last_polls[key] = timestamp
+                if self.db is not None:
+                    self._record_users(timestamp, key, last_poll, vpn)
+            if closed and self.db is not None:
+                self._store(timestamp, closed)
+
+    def _record_users(self, timestamp, key, last_poll, vpn):
+        users = {}
+        sessions = vpn['sessions'].index() if vpn.get('sessions') else {}
+        session_counters = {}
+        last_counters = self.session_counters.get(key, {})
+        for session in sessions.values():
+            counters = (session.bytes_recv, session.bytes_sent)
+            session_counters[session.key] = counters
+            previous = last_counters.get(session.key)
+            if previous is None:
+                # a session found at startup has no known beginning
+                if last_poll is None or session._connected_since < last_poll:
+                    continue
+                previous = (0, 0)
+            total = users.setdefault(session.username, [0, 0])
+            total[0] += self.delta(previous[0], counters[0])
+            total[1] += self.delta(previous[1], counters[1])
+        for username, total in users.items():
+            if total[0] or total[1]:
+                self._add(timestamp, 'user:{0!s}:{1!s}'.format(key, username),
+                          total[0], total[1])
+        # sessions that went away are forgotten
+        self.session_counters[key] = session_counters
+
+    def _add(self, timestamp, series, bytes_in, bytes_out):
+        for resolution, keep in self.tiers:
+            bucket = self.open.get((series, resolution))
+            if bucket is None:
+                bucket = [int(timestamp) - int(timestamp) % resolution, 0, 0]
+                self.open[(series, resolution)] = bucket
+            bucket[1] += bytes_in
+            bucket[2] += bytes_out
+
+    def _close_buckets(self, timestamp, closed):
+        for (series, resolution), bucket in list(self.open.items()):
+            if bucket[0] + resolution > timestamp:
+                continue
+            del self.open[(series, resolution)]
+            closed.append((series, resolution, bucket[0], bucket[1], bucket[2]))
+            if resolution == self.tiers[0][0] and series.startswith('vpn:'):
+                ring = self.rings.get(series)
+                if ring is None:
+                    ring = self.rings[series] = deque(maxlen=self.ring_size)
+                ring.append(tuple(bucket))
+
+    def _store(self, timestamp, closed):
+        import sqlite3
+        try:
+            # a bucket may already hold traffic from before a restart
+            self.db.executemany('INSERT OR IGNORE INTO traffic VALUES (?, ?, ?, 0, 0)',
+                                [row[:3] for row in closed])
+            self.db.executemany('UPDATE traffic SET bytes_in = bytes_in + ?, '
+                                'bytes_out = bytes_out + ? WHERE series = ? '
+                                'AND resolution = ? AND ts = ?',
+                                [row[3:] + row[:3] for row in closed])
+            for resolution, keep in self.tiers:
+                self.db.execute('DELETE FROM traffic WHERE resolution = ? AND ts < ?',
+                                (resolution, int(timestamp) - keep))
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.db.rollback()
+            warning('Unable to store traffic history in {0!s}: {1!s}'.format(self.path, e))
+
+    def query(self, series, start, end=None, resolution=60):
+        """Return (bucket, bytes_in/s, bytes_out/s) of closed buckets from start to end."""
+        if end is None:
+            end = time.time()
+        with self.lock:
+            ring = self.rings.get(series) if resolution == self.tiers[0][0] else None
+            if ring and ring[0][0] <= start:
+                rows = [row for row in ring if start <= row[0] < end]
+            elif self.db is not None:
+                rows = self.db.execute('SELECT ts, bytes_in, bytes_out FROM traffic '
+                                       'WHERE series = ? AND resolution = ? AND ts >= ? '
+                                       'AND ts < ? ORDER BY ts',
+                                       (series, resolution, int(start), end)).fetchall()
+            else:
+                rows = list(ring or ())
+                rows = [row for row in rows if start <= row[0] < end]
+        return [(ts, bytes_in / resolution, bytes_out / resolution)
+                for ts, bytes_in, bytes_out in rows]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+class SessionLog(object):
+    """Completed sessions, written in batches to an SQLite database.
+
+    Sessions are stored when they disconnect, in one table per month of
+    disconnection (sessions_YYYYMM, UTC), each indexed by username, by time
+    and by country code, kept in upper case. Queries only read the tables of
+    the months they cover, and retention drops whole tables, which costs the
+    same however many sessions they hold.
+    """
+
+    batch_size = 1000
+    columns = ('vpn', 'username', 'remote_ip', 'port', 'country', 'city',
+               'connected_since', 'last_seen', 'disconnected', 'bytes_recv', 'bytes_sent')
+    prefix = 'sessions_'
+
+    def __init__(self, path, months=12, readonly=False):
+        self.path = path
+        self.months = months
+        self.lock = threading.Lock()
+        self.pending = []
+        # readers must not create the collector's file, nor lock it
+        self.db = connect_sqlite(path, readonly)
+        self.tables = set(self.partitions())
+
+    def partitions(self):
+        rows = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                               "AND name LIKE 'sessions\\_%' ESCAPE '\\'").fetchall()
+        return sorted(row[0] for row in rows)
+
+    @classmethod
+    def partition(cls, timestamp):
+        return cls.prefix + time.strftime('%Y%m', time.gmtime(timestamp))
+
+    @classmethod
+    def first_partition(cls, timestamp, months):
+        """Return the table of the month months - 1 before that of timestamp."""
+        now = time.gmtime(timestamp)
+        month = now.tm_year * 12 + now.tm_mon - 1 - (months - 1)
+        return '{0!s}{1:04d}{2:02d}'.format(cls.prefix, month // 12, month % 12 + 1)
+
+    def event(self, timestamp, event, key, session):
+        """Collector listener, keeping the sessions that disconnect."""
+        if event != 'disconnect':
+            return
+        row = (key, session.username, format_address(session._remote_ip),
+               session.port or None, session.location.upper(), session.city,
+               session._connected_since, session._last_seen, int(timestamp),
+               session.bytes_recv, session.bytes_sent)
+        with self.lock:
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self._flush()
+
+    def _flush(self):
+        import sqlite3
+        rows, self.pending = self.pending, []
+        first = self.first_partition(time.time(), self.months)
+        tables = {}
+        for row in rows:
+            table = self.partition(row[8])
+            # sessions already past the retention would be dropped anyway
+            if table >= first:
+                tables.setdefault(table, []).append(row)
+        insert = 'INSERT INTO {0!s} VALUES ({1!s})'.format(
+            '{0!s}', ', '.join('?' for column in self.columns))
+        try:
+            created = False
+            for table, table_rows in sorted(tables.items()):
+                if table not in self.tables:
+                    self._create(table)
+                    created = True
+                self.db.executemany(insert.format(table), table_rows)
+            if created:
+                # a new month is the time to drop the oldest one
+                self._expire(first)
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.db.rollback()
+            self.tables = set(self.partitions())
+            warning('Unable to store sessions in {0!s}: {1!s}'.format(self.path, e))
+
+    def _create(self, table):
+        self.db.execute('CREATE TABLE IF NOT EXISTS {0!s} ('
+                        'vpn TEXT NOT NULL, username TEXT NOT NULL, remote_ip TEXT, '
+                        'port INTEGER, country TEXT, city TEXT, '
+                        'connected_since INTEGER NOT NULL, last_seen INTEGER, '
+                        'disconnected INTEGER NOT NULL, bytes_recv INTEGER NOT NULL, '
+                        'bytes_sent INTEGER NOT NULL)'.format(table))
+        self.db.execute('CREATE INDEX IF NOT EXISTS {0!s}_username ON {0!s} '
+                        '(username, disconnected)'.format(table))
+        self.db.execute('CREATE INDEX IF NOT EXISTS {0!s}_country ON {0!s} '
+                        '(country, disconnected)'.format(table))
+        # covers the top talkers query, which then never reads the table
+        self.db.execute('CREATE INDEX IF NOT EXISTS {0!s}_time ON {0!s} '
+                        '(disconnected, username, bytes_recv, bytes_sent)'.format(table))
+        self.tables.add(table)
+
+    def _expire(self, first):
+        for table in sorted(self.tables):
+            if table < first:
+                self.db.execute('DROP TABLE {0!s}'.format(table))
+                self.tables.discard(table)
+
+    def _covering(self, start, end):
+        first = self.partition(start) if start else ''
+        last = self.partition(end)
+        return [table for table in sorted(self.tables) if first <= table <= last]
+
+    def sessions(self, username=None, country=None, start=0, end=None, limit=100):
+        """Return the sessions that disconnected from start to end, newest first."""
+        if end is None:
+            end = time.time()
+        conditions = ['disconnected >= ?', 'disconnected < ?']
+        params = [int(start), int(end)]
+        if username is not None:
+            conditions.append('username = ?')
+            params.append(username)
+        if country is not None:
+            conditions.append('country = ?')
+            params.append(country.upper())
+        with self.lock:
+            tables = self._covering(start, end)
+            if not tables:
+                return []
+            query = ' UNION ALL '.join(
+                'SELECT {0!s} FROM {1!s} WHERE {2!s}'.format(
+                    ', '.join(self.columns), table, ' AND '.join(conditions))
+                for table in tables)
+            rows = self.db.execute(query + ' ORDER BY disconnected DESC LIMIT ?',
+                                   params * len(tables) + [limit]).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def top_talkers(self, start, end=None, limit=10):
+        """Return the users that moved the most bytes in the sessions that
+        disconnected from start to end."""
+        if end is None:
+            end = time.time()
+        with self.lock:
+            tables = self._covering(start, end)
+            if not tables:
+                return []
+            query = ' UNION ALL '.join(
+                'SELECT username, bytes_recv, bytes_sent FROM {0!s} '
+                'WHERE disconnected >= ? AND disconnected < ?'.format(table)
+                for table in tables)
+            rows = self.db.execute(
+                'SELECT username, COUNT(*), SUM(bytes_recv), SUM(bytes_sent) '
+                'FROM ({0!s}) GROUP BY username '
+                'ORDER BY SUM(bytes_recv) + SUM(bytes_sent) DESC LIMIT ?'.format(query),
+                [int(start), int(end)] * len(tables) + [limit]).fetchall()
+        return [{'username': username, 'sessions': count, 'bytes_recv': bytes_recv,
+                 'bytes_sent': bytes_sent} for username, count, bytes_recv, bytes_sent in rows]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class PollSchedule(object):
+    """When the collector polls each VPN next.
+
+    Every VPN is polled at its own interval, from its section or the global
+    one. While its byte counters do not move the interval doubles, up to
+    max_interval, and it drops back as soon as there is traffic. After
+    max_failures failed polls in a row the circuit opens: the VPN is only
+    tried again after a backoff that doubles up to max_interval, and its
+    last good data is served marked stale in the meantime.
+    """
+
+    def __init__(self, vpns, settings):
+        default = float(settings.get('interval', 60))
+        self.max_failures = int(settings.get('max_failures', 3))
+        # key -> [interval, max_interval, current interval, next poll, failures]
+        self.entries = OrderedDict()
+        for key, vpn in vpns.items():
+            interval = float(vpn.get('interval', default))
+            max_interval = float(vpn.get('max_interval',
+                                         settings.get('max_interval', 5 * interval)))
+            self.entries[key] = [interval, max_interval, interval, 0, 0]
+
+    def due(self, now):
+        return [key for key, entry in self.entries.items() if entry[3] <= now]
+
+    def next_poll(self):
+        return min(entry[3] for entry in self.entries.values())
+
+    def update(self, key, now, success, busy=True):
+        entry = self.entries[key]
+        interval, max_interval = entry[0], entry[1]
+        if not success:
+            entry[4] += 1
+            failures = entry[4] - self.max_failures
+            if failures >= 0:
+                # the circuit is open, only try now and then
+                entry[2] = min(max_interval, interval * 2 ** (failures + 1))
+            else:
+                entry[2] = interval
+        else:
+            entry[4] = 0
+            if busy:
+                entry[2] = interval
+            else:
+                entry[2] = min(max_interval, entry[2] * 2)
+        entry[3] = now + entry[2]
+
+    def is_open(self, key):
+        return self.entries[key][4] >= self.max_failures
+
+
+class OpenvpnCollector(object):
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        # the snapshot is only written out when a path is configured
+        self.path = cfg.settings.get('snapshot')
+        self.snapshot = None
+        self.interval = float(cfg.settings.get('interval', 60))
+        self.generation = 0
+        self.pool = ConnectionPool(persistent=cfg.settings.get('persistent') == 'True' or
+                                   cfg.settings.get('push') == 'True')
+        # sessions of the last successful poll of each VPN
+        self.previous = {}
+        self.events = deque(maxlen=1000)
+        self.listeners = []
+        # called with the previous and the new snapshot after every poll
+        self.snapshot_listeners = []
+        self.history = TrafficHistory(cfg.settings.get('history'))
+        self.session_log = None
+        if cfg.settings.get('session_log'):
+            self.session_log = SessionLog(cfg.settings['session_log'],
+                                          int(cfg.settings.get('session_log_months', 12)))
+            self.listeners.append(self.session_log.event)
+        self.schedule = PollSchedule(cfg.vpns, cfg.settings)
+        previous = None
+        if self.path and os.path.exists(self.path):
+            previous = Snapshot.load(self.path)
+        if previous is not None:
+            self.snapshot = previous
+            self.generation = previous.generation
+            self.events.extend(previous.events)
+            self.update_sessions(previous.vpns, emit=False)
+
+    def poll(self):
+        due = set(self.schedule.due(time.time()))
+        vpns = OrderedDict((key, dict(vpn)) for key, vpn in self.cfg.vpns.items()
+                           if key in due)
+        monitor = OpenvpnMonitor(vpns, self.cfg.settings, self.pool, self.previous)
+        # readers of the snapshot should never need the GeoIP database
+        if self.cfg.settings.get('geoip', 'batch') != 'batch':
+            locate_vpns(monitor.vpns, monitor.geoip)
+        last = self.snapshot.vpns if self.snapshot is not None else {}
+        for key in list(monitor.vpns):
+            self.reschedule(key, monitor.vpns, last.get(key), monitor.timestamp)
+        self.update_sessions(monitor.vpns)
+        self.history.record(monitor.timestamp, monitor.vpns)
+        if self.session_log is not None:
+            self.session_log.flush()
+        for vpn in monitor.vpns.values():
+            if vpn.get('socket_connected') and vpn.get('sessions') and not vpn.get('stale'):
+                vpn['session_index'] = SessionIndex(vpn['sessions'])
+                if self.cfg.settings.get('maps') == 'True':
+                    vpn['session_index'].locations()
+        # VPNs that were not due keep what they had
+        vpns = OrderedDict()
+        for key in self.cfg.vpns:
+            if key in monitor.vpns:
+                vpns[key] = monitor.vpns[key]
+            elif key in last:
+                vpns[key] = last[key]
+        self.generation += 1
+        snapshot = Snapshot(vpns, self.generation, monitor.timestamp, list(self.events))
+        if self.path:
+            snapshot.save(self.path)
+            if args.debug:
+                debug("=== wrote snapshot {0!s} to {1!s}".format(self.generation, self.path))
+        previous, self.snapshot = self.snapshot, snapshot
+        for listener in self.snapshot_listeners:
+            listener(previous, snapshot)
+        return snapshot
+
+    def reschedule(self, key, vpns, last, timestamp):
+        """Schedule the next poll of a VPN just polled, keeping its last good
+        data, marked stale, when it failed."""
+        vpn = vpns[key]
+        if 'site' in vpn:
+            success = not vpn.get('stale')
+            # an unchanged site answers with the list it sent before
+            busy = last is None or last.get('site') is not vpn['site']
+        else:
+            success = bool(vpn.get('socket_connected'))
+            busy = last is None or last.get('stats') != vpn.get('stats')
+        if success:
+            vpn['collected'] = timestamp
+        elif last is not None and last.get('socket_connected') and 'site' not in vpn:
+            stale = dict(last)
+            stale['stale'] = True
+            stale['error'] = vpn.get('error', 'Connection refused')
+            vpns[key] = stale
+        self.schedule.update(key, timestamp, success, busy)
+        if args.debug and not success and self.schedule.is_open(key):
+            debug("=== {0!s} failed {1!s} times, next poll in {2:.0f}s".format(
+                key, self.schedule.entries[key][4], self.schedule.entries[key][2]))
+
+    def update_sessions(self, vpns, emit=True):
+        now = time.time()
+        for key, vpn in vpns.items():
+            if 'site' in vpn:
+                # sites are asked for changes since their last list
+                self.previous[key] = vpn['site']
+                continue
+            if not vpn.get('socket_connected') or 'sessions' not in vpn:
+                continue
+            current = vpn['sessions']
+            previous = self.previous.get(key)
+            if emit and previous is not None:
+                current_index = current.index()
+                previous_index = previous.index()
+                for skey, session in current_index.items():
+                    if skey not in previous_index:
+                        self.emit(now, 'connect', key, session)
+                for skey, session in previous_index.items():
+                    if skey not in current_index:
+                        self.emit(now, 'disconnect', key, session)
+            self.previous[key] = current
+
+    def emit(self, timestamp, event, key, session):
+        self.events.append((timestamp, event, key, session))
+        if args.debug:
+            debug("=== {0!s} {1!s} {2!s} {3!s}".format(
+                event, key, session.username, session.remote_ip))
+        for listener in self.listeners:
+            listener(timestamp, event, key, session)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    self.poll()
+                    wait = self.schedule.next_poll() - time.time()
+                except Exception as e:
+                    warning('Collection failed: {0!s}'.format(e))
+                    wait = self.interval
+                time.sleep(max(0, wait))
+        finally:
+            self.pool.close_all()
+            self.history.close()
+            if self.session_log is not None:
+                self.session_log.close()
+
+
+class OpenvpnHtmlPrinter(object):
+    """Renders the page into a list of fragments, joined once by html().
+
+    The formatted cells of every server session are kept in cell_cache by
+    session key, so a long running process only formats the sessions that
+    changed. Renders of --serve share it across threads: entries are tuples
+    replaced in one step, and sessions that are gone are dropped once per
+    collection rather than by each render.
+    """
+
+    cell_cache = {}
+    # timestamp of the collection the cache was last pruned for
+    cell_cache_timestamp = None
+    cell_cache_lock = threading.Lock()
+
+    server_row_head = ('<tr data-session="{0!s}" data-since="{1!s}"><td>{2!s}</td>'
+                       '<td>{3!s}</td><td>{4!s}</td><td>{5!s}</td><td>{6!s}</td>')
+    server_row_tail = '<td>{1!s}</td><td>{2!s}</td><td>{0!s}</td><td>{3!s}</td>'
+
+    live_script = """
+(function () {
+    if (!window.EventSource) {
+        setTimeout(function () { location.reload(); }, 300000);
+        return;
+    }
+    function duration(seconds) {
+        var days = Math.floor(seconds / 86400);
+        var hours = Math.floor(seconds % 86400 / 3600);
+        var minutes = ('0' + Math.floor(seconds % 3600 / 60)).slice(-2);
+        var text = hours + ':' + minutes + ':' + ('0' + seconds % 60).slice(-2);
+        if (days) {
+            text = days + (days == 1 ? ' day, ' : ' days, ') + text;
+        }
+        return text;
+    }
+    // the stream only says how many sessions changed, so ask for the
+    // counters of the rows shown and strike out those that are gone
+    function refresh(key, panel) {
+        var rows = panel.querySelectorAll('tr[data-session]');
+        if (!rows.length) {
+            return;
+        }
+        var ids = [];
+        for (var i = 0; i < rows.length; i++) {
+            ids.push(rows[i].getAttribute('data-session'));
+        }
+        var request = new XMLHttpRequest();
+        request.open('GET', 'api/vpns/' + encodeURIComponent(key) + '/counters?ids=' +
+                     ids.join(','));
+        request.onload = function () {
+            if (request.status != 200) {
+                return;
+            }
+            var counters = JSON.parse(request.responseText).counters;
+            for (var i = 0; i < rows.length; i++) {
+                var cells = rows[i].getElementsByTagName('td');
+                var row = counters[ids[i]];
+                if (row) {
+                    cells[5].textContent = row[0];
+                    cells[6].textContent = row[1];
+                    cells[8].textContent = row[2];
+                } else {
+                    rows[i].className = 'text-muted';
+                    rows[i].style.textDecoration = 'line-through';
+                }
+            }
+        };
+        request.send();
+    }
+    var added = {};
+    var source = new EventSource('events?since=' + document.body.getAttribute('data-generation'));
+    source.addEventListener('reload', function () {
+        source.close();
+        location.reload();
+    });
+    source.onmessage = function (event) {
+        var update = JSON.parse(event.data);
+        for (var key in update.vpns) {
+            var vpn = update.vpns[key];
+            var panel = document.getElementById(vpn.anchor);
+            if (!panel || !vpn.stats) {
+                continue;
+            }
+            for (var stat in vpn.stats) {
+                var cell = panel.querySelector('[data-stat="' + stat + '"]');
+                if (cell) {
+                    cell.textContent = vpn.stats[stat];
+                }
+            }
+            if (vpn.changed || vpn.removed) {
+                refresh(key, panel);
+            }
+            added[key] = (added[key] || 0) + vpn.added;
+            var notice = panel.querySelector('[data-stat="added"]');
+            if (notice && added[key]) {
+                notice.textContent = added[key] + ' new session(s), reload to show';
+            }
+        }
+        var rows = document.querySelectorAll('tr[data-since]');
+        for (var j = 0; j < rows.length; j++) {
+            var since = parseInt(rows[j].getAttribute('data-since'), 10);
+            rows[j].getElementsByTagName('td')[9].textContent =
+                duration(Math.max(0, update.timestamp - since));
+        }
+        document.getElementById('last_update').textContent = update.updated;
+    };
+})();
+"""
+
+    def __init__(self, cfg, monitor, query='', live=False):
 
         self.init_vars(cfg.settings, monitor)
+        # live pages follow /events instead of reloading, which needs a snapshot
+        self.generation = getattr(monitor, 'generation', None)
+        self.live = live and self.generation is not None
+        self.params = dict((name, values[0]) for name, values in parse_qs(query).items())
+        self.out = []
+        self.prune_cell_cache()
+        started = timings and time.time()
         self.print_html_header()
+        if timings:
+            timings.record('page', 'header', started)
+        if self.sites:
+            self.print_totals()
         for key, vpn in self.vpns:
-            if vpn['socket_connected']:
-                self.print_vpn(vpn)
+            started = timings and time.time()
+            timing_scope.name = vpn['name']
+            if vpn['socket_connected'] and 'site' in vpn:
+                self.print_site(vpn)
+            elif vpn['socket_connected']:
+                self.print_vpn(key, vpn)
             else:
                 self.print_unavailable_vpn(vpn)
+            timing_scope.name = 'page'
+            if timings:
+                timings.record(vpn['name'], 'render', started)
         if self.maps:
+            started = timings and time.time()
             self.print_maps_html()
-            self.print_html_footer()
+            if timings:
+                timings.record('page', 'maps', started)
+        self.print_html_footer()
+
+    def html(self):
+        return ''.join(self.out)
+
+    def prune_cell_cache(self):
+        cls = OpenvpnHtmlPrinter
+        if cls.cell_cache_timestamp == self.timestamp:
+            return
+        with cls.cell_cache_lock:
+            if cls.cell_cache_timestamp == self.timestamp:
+                return
+            keys = set(session.key for session in iter_sessions(OrderedDict(self.vpns)))
+            for key in list(cls.cell_cache):
+                if key not in keys:
+                    cls.cell_cache.pop(key, None)
+            cls.cell_cache_timestamp = self.timestamp
+
+    def write(self, fragment):
+        self.out.append(fragment)
+        self.out.append('\n')
 
     def init_vars(self, settings, monitor):
 
         self.vpns = list(monitor.vpns.items())
+        self.timestamp = monitor.timestamp
+        self.now = int(time.time())
 
         self.site = 'Example'
         if 'site' in settings:
@@ -386,6 +2326,13 @@ class OpenvpnHtmlPrinter(object):
         if 'maps' in settings and settings['maps'] == 'True':
             self.maps = True
 
+        self.page_size = int(settings.get('page_size', 100))
+
+        # the page of a central instance opens with the totals of all sites
+        self.sites = [vpn for key, vpn in self.vpns if 'url' in vpn]
+        if self.sites:
+            self.totals = vpn_totals(monitor.vpns)
+
         self.latitude = -37.8067
         self.longitude = 144.9635
         if 'latitude' in settings:
@@ -395,64 +2342,66 @@ class OpenvpnHtmlPrinter(object):
 
     def print_html_header(self):
 
-        print("Content-Type: text/html\n")
-        print('<!doctype html>')
-        print('<html><head>')
-        print('<meta charset="utf-8">')
-        print('<meta http-equiv="X-UA-Compatible" content="IE=edge">')
-        print('<meta name="viewport" content="width=device-width, initial-scale=1">')
-        print('<title>{0!s} OpenVPN Status Monitor</title>'.format(self.site))
-        print('<meta http-equiv="refresh" content="300" />')
+        self.write('<!doctype html>')
+        self.write('<html><head>')
+        self.write('<meta charset="utf-8">')
+        self.write('<meta http-equiv="X-UA-Compatible" content="IE=edge">')
+        self.write('<meta name="viewport" content="width=device-width, initial-scale=1">')
+        self.write('<title>{0!s} OpenVPN Status Monitor</title>'.format(self.site))
+        if not self.live:
+            self.write('<meta http-equiv="refresh" content="300" />')
 
         if self.maps:
             self.print_maps_header()
 
-        print('<script src="//code.jquery.com/jquery-1.12.1.min.js"></script>')
-        print('<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" integrity="sha384-1q8mTJOASx8j1Au+a5WDVnPi2lkFfwwEAa8hDDdjZlpLegxhjVME1fgjWPGmkzs7" crossorigin="anonymous">')
-        print('<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap-theme.min.css" integrity="sha384-fLW2N01lMqjakBkx3l/M9EahuwpSfeNvV63J5ezn3uZzapT0u7EYsXMjQV+0En5r" crossorigin="anonymous">')
-        print('<script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/js/bootstrap.min.js" integrity="sha384-0mSbJDEHialfmuBBQP6A4Qrprq5OVfW37PRR3j5ELqxss1yVqOtnepnHVP9aJ7xS" crossorigin="anonymous"></script>')
-        print('<body>')
-
-        print('<nav class="navbar navbar-inverse">')
-        print('<div class="container-fluid">')
-        print('<div class="navbar-header">')
-        print('<button type="button" class="navbar-toggle" ')
-        print('data-toggle="collapse" data-target="#myNavbar">')
-        print('<span class="icon-bar"></span>')
-        print('<span class="icon-bar"></span>')
-        print('<span class="icon-bar"></span>')
-        print('</button>')
-
-        print('<a class="navbar-brand" href="#">')
-        print('{0!s} OpenVPN Status Monitor</a>'.format(self.site))
-
-        print('</div><div class="collapse navbar-collapse" id="myNavbar">')
-        print('<ul class="nav navbar-nav"><li class="dropdown">')
-        print('<a class="dropdown-toggle" data-toggle="dropdown" href="#">VPN')
-        print('<span class="caret"></span></a>')
-        print('<ul class="dropdown-menu">')
+        self.write('<script src="//code.jquery.com/jquery-1.12.1.min.js"></script>')
+        self.write('<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" integrity="sha384-1q8mTJOASx8j1Au+a5WDVnPi2lkFfwwEAa8hDDdjZlpLegxhjVME1fgjWPGmkzs7" crossorigin="anonymous">')
+        self.write('<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap-theme.min.css" integrity="sha384-fLW2N01lMqjakBkx3l/M9EahuwpSfeNvV63J5ezn3uZzapT0u7EYsXMjQV+0En5r" crossorigin="anonymous">')
+        self.write('<script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/js/bootstrap.min.js" integrity="sha384-0mSbJDEHialfmuBBQP6A4Qrprq5OVfW37PRR3j5ELqxss1yVqOtnepnHVP9aJ7xS" crossorigin="anonymous"></script>')
+        if self.live:
+            self.write('<body data-generation="{0!s}">'.format(self.generation))
+        else:
+            self.write('<body>')
+
+        self.write('<nav class="navbar navbar-inverse">')
+        self.write('<div class="container-fluid">')
+        self.write('<div class="navbar-header">')
+        self.write('<button type="button" class="navbar-toggle" ')
+        self.write('data-toggle="collapse" data-target="#myNavbar">')
+        self.write('<span class="icon-bar"></span>')
+        self.write('<span class="icon-bar"></span>')
+        self.write('<span class="icon-bar"></span>')
+        self.write('</button>')
+
+        self.write('<a class="navbar-brand" href="#">')
+        self.write('{0!s} OpenVPN Status Monitor</a>'.format(self.site))
+
+        self.write('</div><div class="collapse navbar-collapse" id="myNavbar">')
+        self.write('<ul class="nav navbar-nav"><li class="dropdown">')
+        self.write('<a class="dropdown-toggle" data-toggle="dropdown" href="#">VPN')
+        self.write('<span class="caret"></span></a>')
+        self.write('<ul class="dropdown-menu">')
 
         for key, vpn in self.vpns:
             if vpn['name']:
                 anchor = vpn['name'].lower().replace(' ', '_')
-                print('<li><a href="#{0!s}">{1!s}</a></li>'.format(anchor, vpn['name']))
-        print('</ul></li>')
+                self.write('<li><a href="#{0!s}">{1!s}</a></li>'.format(anchor, vpn['name']))
+        self.write('</ul></li>')
 
         if self.maps:
-            print('<li><a href="#map_canvas">Map View</a></li>')
+            self.write('<li><a href="#map_canvas">Map View</a></li>')
 
-        print('</ul>')
+        self.write('</ul>')
 
         if self.logo:
-            print('<a href="#" class="pull-right"><img alt="self.logo" ')
-            print('style="max-height:46px; padding-top:3px;" ')
-            print('src="{0!s}"></a>'.format(self.logo))
+            self.write('<a href="#" class="pull-right"><img alt="self.logo" ')
+            self.write('style="max-height:46px; padding-top:3px;" ')
+            self.write('src="{0!s}"></a>'.format(self.logo))
 
-        print('</div></div></nav>')
-        print('<div class="container-fluid">')
+        self.write('</div></div></nav>')
+        self.write('<div class="container-fluid">')
 
-    @staticmethod
-    def print_session_table_headers(vpn_mode):
+    def print_session_table_headers(self, vpn_mode, links=None):
 
         server_headers = ['Username / Hostname', 'VPN IP Address',
                           'Remote IP Address', 'Port', 'Location', 'Bytes In',
@@ -465,27 +2414,94 @@ class OpenvpnHtmlPrinter(object):
         elif vpn_mode == 'Server':
             headers = server_headers
 
-        print('<table class="table table-striped table-bordered table-hover ')
-        print('table-condensed table-responsive">')
-        print('<thead><tr>')
+        self.write('<table class="table table-striped table-bordered table-hover ')
+        self.write('table-condensed table-responsive">')
+        self.write('<thead><tr>')
         for header in headers:
-            print('<th>{0!s}</th>'.format(header))
-        print('</tr></thead><tbody>')
+            if links and header in links:
+                self.write('<th><a href="{0!s}">{1!s}</a></th>'.format(links[header], header))
+            else:
+                self.write('<th>{0!s}</th>'.format(header))
+        self.write('</tr></thead><tbody>')
 
-    @staticmethod
-    def print_session_table_footer():
-        print('</tbody></table>')
+    def print_session_table_footer(self):
+        self.write('</tbody></table>')
 
-    @staticmethod
-    def print_unavailable_vpn(vpn):
+    def print_unavailable_vpn(self, vpn):
         anchor = vpn['name'].lower().replace(' ', '_')
-        print('<div class="panel panel-danger" id="{0!s}">'.format(anchor))
-        print('<div class="panel-heading">')
-        print('<h3 class="panel-title">{0!s}</h3></div>'.format(vpn['name']))
-        print('<div class="panel-body">')
-        print('Connection refused to {0!s}:{1!s} </div></div>'.format(vpn['host'], vpn['port']))
-
-    def print_vpn(self, vpn):
+        self.write('<div class="panel panel-danger" id="{0!s}">'.format(anchor))
+        self.write('<div class="panel-heading">')
+        self.write('<h3 class="panel-title">{0!s}</h3></div>'.format(vpn['name']))
+        self.write('<div class="panel-body">')
+        if 'url' in vpn:
+            where = vpn['url']
+        else:
+            where = '{0!s}:{1!s}'.format(vpn['host'], vpn['port'])
+        self.write('{0!s} to {1!s} </div></div>'.format(
+            escape(vpn.get('error', 'Connection refused')), where))
+
+    def print_totals(self):
+        current = [vpn for vpn in self.sites if vpn['socket_connected'] and
+                   not vpn.get('stale')]
+        self.write('<div class="panel panel-info" id="all_sites">')
+        self.write('<div class="panel-heading"><h3 class="panel-title">All Sites</h3>')
+        self.write('</div><div class="panel-body">')
+        self.write('<table class="table table-condensed table-responsive">')
+        self.write('<thead><tr><th>Sites</th><th>Clients</th>')
+        self.write('<th>Total Bytes In</th><th>Total Bytes Out</th></tr></thead><tbody>')
+        self.write('<tr><td>{0!s} of {1!s} current</td>'.format(len(current), len(self.sites)))
+        self.write('<td>{0!s}</td>'.format(self.totals['nclients']))
+        self.write('<td>{0!s}</td>'.format(format_bytes(self.totals['bytesin'])))
+        self.write('<td>{0!s}</td>'.format(format_bytes(self.totals['bytesout'])))
+        self.write('</tr></tbody></table></div></div>')
+
+    def print_site(self, vpn):
+        # names and errors come from the other instance
+        site = vpn['site']
+        anchor = vpn['name'].lower().replace(' ', '_')
+        if vpn.get('stale'):
+            self.write('<div class="panel panel-warning" id="{0!s}">'.format(anchor))
+        else:
+            self.write('<div class="panel panel-success" id="{0!s}">'.format(anchor))
+        self.write('<div class="panel-heading"><h3 class="panel-title">{0!s} '.format(
+            vpn['name']))
+        self.write('<small><a href="{0!s}">{0!s}</a></small></h3>'.format(
+            escape(vpn['url'])))
+        self.write('</div><div class="panel-body">')
+        if vpn.get('stale'):
+            self.write('<p class="text-warning">{0!s}, showing the VPNs as of {1!s}</p>'.format(
+                escape(vpn['error']), format_time(site['timestamp'])))
+        self.write('<table class="table table-condensed table-responsive">')
+        self.write('<thead><tr><th>VPN</th><th>VPN Mode</th><th>Status</th><th>Pingable</th>')
+        self.write('<th>Clients</th><th>Total Bytes In</th><th>Total Bytes Out</th>')
+        self.write('<th>Up Since</th></tr></thead><tbody>')
+        for remote in site['vpns']:
+            if remote.get('stale'):
+                self.write('<tr class="warning"><td>{0!s}</td>'.format(escape(remote['name'])))
+            else:
+                self.write('<tr><td>{0!s}</td>'.format(escape(remote['name'])))
+            if not remote['connected']:
+                self.write('<td colspan="7" class="danger">{0!s}</td></tr>'.format(
+                    escape(remote['error'])))
+                continue
+            if 'nclients' not in remote:
+                self.write('<td colspan="7"><a href="{0!s}">{0!s}</a></td></tr>'.format(
+                    escape(remote['url'])))
+                continue
+            self.write('<td>{0!s}</td>'.format(escape(remote['mode'])))
+            self.write('<td>{0!s}</td>'.format(escape(remote['state'])))
+            self.write('<td>{0!s}</td>'.format(
+                'Yes' if remote.get('success') == 'SUCCESS' else 'No'))
+            self.write('<td>{0!s}</td>'.format(remote['nclients']))
+            self.write('<td>{0!s}</td>'.format(format_bytes(remote['bytesin'])))
+            self.write('<td>{0!s}</td>'.format(format_bytes(remote['bytesout'])))
+            self.write('<td>{0!s}</td></tr>'.format(format_time(remote['up_since'])))
+        self.write('</tbody></table>')
+        self.write('<span class="label label-default">Collected {0!s}</span>'.format(
+            format_time(site['timestamp'])))
+        self.write('</div></div>')
+
+    def print_vpn(self, key, vpn):
 
         if vpn['state']['success'] == 'SUCCESS':
             pingable = 'Yes'
@@ -503,139 +2519,1021 @@ class OpenvpnHtmlPrinter(object):
         up_since = vpn['state']['up_since']
 
         anchor = vpn['name'].lower().replace(' ', '_')
-        print('<div class="panel panel-success" id="{0!s}">'.format(anchor))
-        print('<div class="panel-heading"><h3 class="panel-title">{0!s}</h3>'.format(
+        if vpn.get('stale'):
+            self.write('<div class="panel panel-warning" id="{0!s}">'.format(anchor))
+        else:
+            self.write('<div class="panel panel-success" id="{0!s}">'.format(anchor))
+        self.write('<div class="panel-heading"><h3 class="panel-title">{0!s}</h3>'.format(
             vpn['name']))
-        print('</div><div class="panel-body">')
-        print('<table class="table table-condensed table-responsive">')
-        print('<thead><tr><th>VPN Mode</th><th>Status</th><th>Pingable</th>')
-        print('<th>Clients</th><th>Total Bytes In</th><th>Total Bytes Out</th>')
-        print('<th>Up Since</th><th>Local IP Address</th>')
+        self.write('</div><div class="panel-body">')
+        if vpn.get('stale'):
+            self.write('<p class="text-warning">{0!s} to {1!s}:{2!s}, showing the data '
+                       'of {3!s}</p>'.format(escape(vpn['error']), vpn['host'], vpn['port'],
+                                             format_time(vpn['collected'])))
+        self.write('<table class="table table-condensed table-responsive">')
+        self.write('<thead><tr><th>VPN Mode</th><th>Status</th><th>Pingable</th>')
+        self.write('<th>Clients</th><th>Total Bytes In</th><th>Total Bytes Out</th>')
+        if 'rates' in vpn:
+            self.write('<th>Bytes In/s</th><th>Bytes Out/s</th>')
+        self.write('<th>Up Since</th><th>Local IP Address</th>')
         if vpn_mode == 'Client':
-            print('<th>Remote IP Address</th>')
-        print('</tr></thead><tbody>')
-        print('<tr><td>{0!s}</td>'.format(vpn_mode))
-        print('<td>{0!s}</td>'.format(connection))
-        print('<td>{0!s}</td>'.format(pingable))
-        print('<td>{0!s}</td>'.format(nclients))
-        print('<td>{0!s} ({1!s})</td>'.format(bytesin, naturalsize(bytesin, binary=True)))
-        print('<td>{0!s} ({1!s})</td>'.format(bytesout, naturalsize(bytesout, binary=True)))
-        print('<td>{0!s}</td>'.format(up_since.strftime('%d/%m/%Y %H:%M:%S')))
-        print('<td>{0!s}</td>'.format(local_ip))
+            self.write('<th>Remote IP Address</th>')
+        self.write('</tr></thead><tbody>')
+        self.write('<tr><td>{0!s}</td>'.format(vpn_mode))
+        self.write('<td>{0!s}</td>'.format(connection))
+        self.write('<td>{0!s}</td>'.format(pingable))
+        self.write('<td data-stat="nclients">{0!s}</td>'.format(nclients))
+        self.write('<td data-stat="bytesin">{0!s}</td>'.format(format_bytes(bytesin)))
+        self.write('<td data-stat="bytesout">{0!s}</td>'.format(format_bytes(bytesout)))
+        if 'rates' in vpn:
+            self.write('<td data-stat="ratein">{0!s}</td>'.format(format_rate(vpn['rates'][0])))
+            self.write('<td data-stat="rateout">{0!s}</td>'.format(format_rate(vpn['rates'][1])))
+        self.write('<td>{0!s}</td>'.format(up_since.strftime('%d/%m/%Y %H:%M:%S')))
+        self.write('<td>{0!s}</td>'.format(local_ip))
         if vpn_mode == 'Client':
-            print('<td>{0!s}</td>'.format(remote_ip))
-        print('</tr></tbody></table>')
+            self.write('<td>{0!s}</td>'.format(remote_ip))
+        self.write('</tr></tbody></table>')
 
-        if vpn_mode == 'Client' or nclients > 0:
+        if vpn_mode == 'Client':
             self.print_session_table_headers(vpn_mode)
             self.print_session_table(vpn_mode, vpn_sessions)
             self.print_session_table_footer()
+        elif nclients > 0:
+            self.print_session_page(key, vpn, anchor)
+
+        self.write('<span class="label label-default">{0!s}</span>'.format(vpn['version']))
+        self.write('</div></div>')
+
+    def print_client_session(self, session):
+        self.write('<td>{0!s}</td>'.format(session['tuntap_read']))
+        self.write('<td>{0!s}</td>'.format(session['tuntap_write']))
+        self.write('<td>{0!s}</td>'.format(session['tcpudp_read']))
+        self.write('<td>{0!s}</td>'.format(session['tcpudp_write']))
+        self.write('<td>{0!s}</td>'.format(session['auth_read']))
+
+    def print_server_session(self, session):
+        key = session.key
+        # (static, head cells, counters, tail cells)
+        entry = self.cell_cache.get(key) if key is not None else None
+
+        static = (session._local_ip, session.geo)
+        if entry is not None and entry[0] == static:
+            head = entry[1]
+        else:
+            if 'city' in session and 'country_name' in session:
+                country = session['country_name']
+                city = session['city']
+                if city:
+                    full_location = '{0!s}, {1!s}'.format(city, country)
+                else:
+                    full_location = country
+                flag = 'flags/{0!s}.png'.format(session['location'].lower())
+                location = '<img src="{0!s}" title="{1!s}" alt="{1!s}" /> {1!s}'.format(
+                    flag, full_location)
+            else:
+                location = session['location']
+            head = self.server_row_head.format(
+                session_id(session), session._connected_since, session.username,
+                format_address(session._local_ip) if session._local_ip else '',
+                format_address(session._remote_ip), session.port, location)
+
+        counters = (session.bytes_recv, session.bytes_sent, session._last_seen)
+        if entry is not None and entry[2] == counters:
+            tail = entry[3]
+        else:
+            tail = self.server_row_tail.format(
+                format_time(session._connected_since), *format_counters(session))
+
+        if key is not None and (entry is None or entry[1] is not head or
+                                entry[3] is not tail):
+            self.cell_cache[key] = (static, head, counters, tail)
+
+        total_time = timedelta(seconds=max(0, self.now - session._connected_since))
+        self.out.append('{0!s}{1!s}<td>{2!s}</td></tr>\n'.format(head, tail, total_time))
+
+    def print_session_table(self, vpn_mode, sessions):
+        for key, session in list(sessions.items()):
+            self.write('<tr>')
+            self.print_client_session(session)
+            self.write('</tr>')
+
+    def session_link(self, key, anchor, **params):
+        query = dict((name, value) for name, value in params.items() if value)
+        query['vpn'] = key
+        return escape('?{0!s}#{1!s}'.format(urlencode(sorted(query.items())), anchor))
+
+    def print_session_page(self, key, vpn, anchor):
+        index = vpn.get('session_index')
+        if index is None:
+            index = vpn['session_index'] = SessionIndex(vpn['sessions'])
+        # paging only applies to the VPN named in the query
+        params = self.params if self.params.get('vpn') == key else {}
+        sort = params.get('sort', 'username')
+        if sort not in SessionIndex.orders:
+            sort = 'username'
+        order = 'desc' if params.get('order') == 'desc' else 'asc'
+        prefix = params.get('filter', '')
+        try:
+            page = max(1, int(params.get('page', 1)))
+        except ValueError:
+            page = 1
+        total, sessions = index.page(sort, order == 'desc', prefix,
+                                     (page - 1) * self.page_size, self.page_size)
+
+        self.write('<form class="form-inline" method="get" action="#{0!s}">'.format(anchor))
+        self.write('<input type="hidden" name="vpn" value="{0!s}">'.format(escape(key, True)))
+        self.write('<input type="hidden" name="sort" value="{0!s}">'.format(sort))
+        self.write('<input type="hidden" name="order" value="{0!s}">'.format(order))
+        self.write('<input type="text" class="form-control input-sm" name="filter" '
+                   'placeholder="Username" value="{0!s}">'.format(escape(prefix, True)))
+        self.write('<button type="submit" class="btn btn-default btn-sm">Filter</button>')
+        self.write('</form>')
+
+        links = {}
+        for header, column in (('Username / Hostname', 'username'), ('Bytes In', 'bytes'),
+                               ('Bytes Out', 'bytes'), ('Connected Since', 'connected_since')):
+            reverse = 'desc' if column == sort and order == 'asc' else 'asc'
+            links[header] = self.session_link(key, anchor, sort=column, order=reverse,
+                                              filter=prefix)
+        self.print_session_table_headers('Server', links)
+        for session in sessions:
+            self.print_server_session(session)
+        self.print_session_table_footer()
+
+        pages = max(1, (total + self.page_size - 1) // self.page_size)
+        first = min(total, (page - 1) * self.page_size + 1)
+        last = min(total, page * self.page_size)
+        self.write('<nav><ul class="pager">')
+        if self.live:
+            self.write('<li class="text-info" data-stat="added"></li>')
+        if page > 1:
+            self.write('<li class="previous"><a href="{0!s}">Previous</a></li>'.format(
+                self.session_link(key, anchor, sort=sort, order=order, filter=prefix,
+                                  page=page - 1)))
+        self.write('<li>{0!s}-{1!s} of {2!s} sessions</li>'.format(first, last, total))
+        if page < pages:
+            self.write('<li class="next"><a href="{0!s}">Next</a></li>'.format(
+                self.session_link(key, anchor, sort=sort, order=order, filter=prefix,
+                                  page=page + 1)))
+        self.write('</ul></nav>')
+
+    def print_maps_header(self):
+        self.write('<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/leaflet/0.7.7/leaflet.css" />')
+        self.write('<script src="//cdnjs.cloudflare.com/ajax/libs/leaflet/0.7.7/leaflet.js"></script>')
 
-        print('<span class="label label-default">{0!s}</span>'.format(vpn['version']))
-        print('</div></div>')
+    def print_maps_html(self):
+        self.write('<div class="panel panel-info"><div class="panel-heading">')
+        self.write('<h3 class="panel-title">Map View</h3></div><div class="panel-body">')
+        self.write('<div id="map_canvas" style="height:500px"></div>')
+        self.write('<script type="text/javascript">')
+        self.write('var map = L.map("map_canvas");')
+        self.write('var centre = L.latLng({0!s}, {1!s});'.format(self.latitude, self.longitude))
+        self.write('map.setView(centre, 8);')
+        self.write('url = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png";')
+        self.write('var layer = new L.TileLayer(url, {});')
+        self.write('map.addLayer(layer);')
+        self.write('var bounds = L.latLngBounds(centre);')
+        # one marker per location, however many sessions are there
+        located = OrderedDict()
+        for vkey, vpn in self.vpns:
+            if not vpn.get('sessions'):
+                continue
+            index = vpn.get('session_index')
+            if index is None:
+                index = vpn['session_index'] = SessionIndex(vpn['sessions'])
+            timing_scope.name = vpn['name']
+            for point, count, names in index.locations():
+                entry = located.get(point)
+                if entry is None:
+                    entry = located[point] = [0, []]
+                entry[0] += count
+                entry[1].extend(names)
+            timing_scope.name = 'page'
+        markers = []
+        for (latitude, longitude), (count, names) in located.items():
+            popup = '<br>'.join(escape(name) for name in names[:SessionIndex.max_names])
+            if count > SessionIndex.max_names:
+                popup += '<br>and {0!s} more'.format(count - SessionIndex.max_names)
+            markers.append([latitude, longitude, popup])
+        self.write('var markers = {0!s};'.format(
+            json.dumps(markers, separators=(',', ':')).replace('</', '<\\/')))
+        self.write('for (var i = 0; i < markers.length; i++) {')
+        self.write('    var latlng = new L.latLng(markers[i][0], markers[i][1]);')
+        self.write('    bounds.extend(latlng);')
+        self.write('    L.marker(latlng).addTo(map).bindPopup(markers[i][2]);')
+        self.write('}')
+        self.write('map.fitBounds(bounds);')
+        self.write('</script>')
+        self.write('</div></div>')
+
+    def print_html_footer(self):
+        updated = datetime.fromtimestamp(self.timestamp)
+        age = max(0, int(time.time() - self.timestamp))
+        self.write('<div class="well well-sm">')
+        if self.live:
+            self.write('Page updates live.')
+            self.write('Last update: <b id="last_update">{0!s}</b></div>'.format(
+                updated.strftime('%a %d/%m/%Y %H:%M:%S')))
+            self.write('<script type="text/javascript">')
+            self.write(self.live_script)
+            self.write('</script>')
+        else:
+            self.write('Page automatically reloads every 5 minutes.')
+            self.write('Last update: <b>{0!s}</b> ({1!s} seconds ago)</div>'.format(
+                updated.strftime('%a %d/%m/%Y %H:%M:%S'), age))
+        self.write('</div></body></html>')
+
+
+def metric_label(value):
+    return '{0!s}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class OpenvpnMetricsPrinter(object):
+    """Prometheus text exposition of a snapshot.
+
+    Per-session series are only written while the total number of sessions is
+    at most max_sessions, the per-country totals are always written.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    server_metrics = (
+        ('openvpn_up', 'gauge', 'Whether the management interface answered'),
+        ('openvpn_clients', 'gauge', 'Number of connected clients'),
+        ('openvpn_bytes_in_total', 'counter', 'Bytes received by the server'),
+        ('openvpn_bytes_out_total', 'counter', 'Bytes sent by the server'),
+        ('openvpn_up_since_seconds', 'gauge', 'Time the VPN came up'),
+    )
+    country_metrics = (
+        ('openvpn_country_sessions', 'gauge', 'Sessions by client country'),
+        ('openvpn_country_bytes_received_total', 'counter',
+         'Bytes received from clients by country'),
+        ('openvpn_country_bytes_sent_total', 'counter', 'Bytes sent to clients by country'),
+    )
+    site_metrics = (
+        ('openvpn_site_up', 'gauge', 'Whether the site answered with its current VPN list'),
+    )
+    session_metrics = (
+        ('openvpn_session_bytes_received_total', 'counter', 'Bytes received from a client'),
+        ('openvpn_session_bytes_sent_total', 'counter', 'Bytes sent to a client'),
+        ('openvpn_session_connected_seconds', 'gauge', 'Seconds a client has been connected'),
+    )
+
+    def __init__(self, cfg, monitor):
+        self.vpns = list(monitor.vpns.items())
+        self.timestamp = monitor.timestamp
+        self.max_sessions = int(cfg.settings.get('metrics_max_sessions', 1000))
+
+    def render(self):
+        lines = []
+        servers = [[] for metric in self.server_metrics]
+        countries = [[] for metric in self.country_metrics]
+        sites = [[] for metric in self.site_metrics]
+        sessions = [[] for metric in self.session_metrics]
+        nsessions = 0
+        for key, vpn in self.vpns:
+            if vpn.get('sessions'):
+                nsessions += len(vpn['sessions'].index())
+        per_session = nsessions <= self.max_sessions
+
+        for key, vpn in self.vpns:
+            vpn_label = metric_label(vpn.get('name', key))
+            if 'url' in vpn:
+                self.site_samples(vpn, vpn_label, servers, sites)
+                continue
+            labels = '{{vpn="{0!s}"}}'.format(vpn_label)
+            up = vpn.get('socket_connected') and not vpn.get('stale')
+            servers[0].append((labels, 1 if up else 0))
+            # the last good data of a VPN that stopped answering is not current
+            if not up:
+                continue
+            servers[1].append((labels, vpn['stats']['nclients']))
+            servers[2].append((labels, vpn['stats']['bytesin']))
+            servers[3].append((labels, vpn['stats']['bytesout']))
+            servers[4].append((labels, int(time.mktime(vpn['state']['up_since'].timetuple()))))
+
+            totals = {}
+            # a common name connected more than once is reported as one series
+            clients = OrderedDict()
+            for session in vpn['sessions'].index().values():
+                country = session.location
+                total = totals.get(country)
+                if total is None:
+                    total = totals[country] = [0, 0, 0]
+                total[0] += 1
+                total[1] += session.bytes_recv
+                total[2] += session.bytes_sent
+                if per_session:
+                    connected = max(0, int(self.timestamp) - session._connected_since)
+                    client = clients.get((session.username, country))
+                    if client is None:
+                        clients[(session.username, country)] = [
+                            session.bytes_recv, session.bytes_sent, connected]
+                    else:
+                        client[0] += session.bytes_recv
+                        client[1] += session.bytes_sent
+                        client[2] = max(client[2], connected)
+            for (username, country), client in clients.items():
+                labels = '{{vpn="{0!s}",common_name="{1!s}",country="{2!s}"}}'.format(
+                    vpn_label, metric_label(username), metric_label(country))
+                for i in range(3):
+                    sessions[i].append((labels, client[i]))
+            for country, total in sorted(totals.items()):
+                labels = '{{vpn="{0!s}",country="{1!s}"}}'.format(
+                    vpn_label, metric_label(country))
+                for i in range(3):
+                    countries[i].append((labels, total[i]))
+
+        groups = [(self.server_metrics, servers), (self.country_metrics, countries)]
+        if sites[0]:
+            groups.append((self.site_metrics, sites))
+        if per_session:
+            groups.append((self.session_metrics, sessions))
+        for metrics, samples in groups:
+            for (name, kind, description), values in zip(metrics, samples):
+                lines.append('# HELP {0!s} {1!s}'.format(name, description))
+                lines.append('# TYPE {0!s} {1!s}'.format(name, kind))
+                for labels, value in values:
+                    lines.append('{0!s}{1!s} {2!s}'.format(name, labels, value))
+        lines.append('# HELP openvpn_sessions_truncated Whether per-session series '
+                     'were left out for exceeding metrics_max_sessions')
+        lines.append('# TYPE openvpn_sessions_truncated gauge')
+        lines.append('openvpn_sessions_truncated {0!s}'.format(0 if per_session else 1))
+        lines.append('# HELP openvpn_snapshot_timestamp_seconds Time of the last collection')
+        lines.append('# TYPE openvpn_snapshot_timestamp_seconds gauge')
+        lines.append('openvpn_snapshot_timestamp_seconds {0!s}'.format(int(self.timestamp)))
+        lines.append('')
+        return '\n'.join(lines)
 
     @staticmethod
-    def print_client_session(session):
-        print('<td>{0!s}</td>'.format(session['tuntap_read']))
-        print('<td>{0!s}</td>'.format(session['tuntap_write']))
-        print('<td>{0!s}</td>'.format(session['tcpudp_read']))
-        print('<td>{0!s}</td>'.format(session['tcpudp_write']))
-        print('<td>{0!s}</td>'.format(session['auth_read']))
+    def site_samples(vpn, site_label, servers, sites):
+        current = vpn.get('socket_connected') and not vpn.get('stale')
+        sites[0].append(('{{site="{0!s}"}}'.format(site_label), 1 if current else 0))
+        if not vpn.get('socket_connected'):
+            return
+        for remote in vpn['site']['vpns']:
+            labels = '{{site="{0!s}",vpn="{1!s}"}}'.format(
+                site_label, metric_label(remote['name']))
+            servers[0].append((labels, 1 if remote['connected'] else 0))
+            # a remote that is itself a site has no totals of its own
+            if not remote['connected'] or 'nclients' not in remote:
+                continue
+            servers[1].append((labels, remote['nclients']))
+            servers[2].append((labels, remote['bytesin']))
+            servers[3].append((labels, remote['bytesout']))
+            servers[4].append((labels, remote['up_since']))
+
+
+class LiveUpdates(object):
+    """What changed between consecutive snapshots, for the /events stream.
+
+    The last size updates are kept as JSON text by generation, so browsers
+    that reconnect catch up instead of reloading the page.
+    """
+
+    def __init__(self, size=100):
+        self.updates = deque(maxlen=size)
+        self.generation = None
+        self.condition = threading.Condition()
+
+    def publish(self, previous, snapshot):
+        update = json.dumps(self.diff(previous, snapshot), separators=(',', ':'))
+        with self.condition:
+            self.updates.append((snapshot.generation, update))
+            self.generation = snapshot.generation
+            self.condition.notify_all()
+
+    def since(self, generation, timeout):
+        """Return the updates after generation, waiting up to timeout for one.
+
+        Returns None when the updates after generation are no longer kept.
+        """
+        with self.condition:
+            pending = self._pending(generation)
+            if pending == []:
+                self.condition.wait(timeout)
+                pending = self._pending(generation)
+            return pending
+
+    def _pending(self, generation):
+        # nothing to compare with until the first snapshot is published
+        if self.generation is None:
+            return []
+        if generation is None:
+            return list(self.updates)
+        if generation > self.generation:
+            return None
+        pending = [update for update in self.updates if update[0] > generation]
+        if pending and pending[0][0] != generation + 1:
+            return None
+        return pending
 
     @staticmethod
-    def print_server_session(session):
-
-        total_time = str(datetime.now() - session['connected_since'])[:-7]
-        bytes_recv = session['bytes_recv']
-        bytes_sent = session['bytes_sent']
-        print('<td>{0!s}</td>'.format(session['username']))
-        print('<td>{0!s}</td>'.format(session['local_ip']))
-        print('<td>{0!s}</td>'.format(session['remote_ip']))
-        print('<td>{0!s}</td>'.format(session['port']))
-
-        if 'city' in session and 'country_name' in session:
-            country = session['country_name']
-            city = session['city']
-            if city:
-                full_location = '{0!s}, {1!s}'.format(city, country)
+    def diff(previous, snapshot):
+        vpns = {}
+        for key, vpn in snapshot.vpns.items():
+            item = {'anchor': vpn['name'].lower().replace(' ', '_'),
+                    'connected': bool(vpn.get('socket_connected'))}
+            vpns[key] = item
+            if not item['connected'] or 'state' not in vpn or \
+                    vpn['state']['mode'] != 'Server':
+                continue
+            stats = vpn['stats']
+            item['stats'] = {'nclients': stats['nclients'],
+                             'bytesin': format_bytes(stats['bytesin']),
+                             'bytesout': format_bytes(stats['bytesout'])}
+            if 'rates' in vpn:
+                item['stats']['ratein'] = format_rate(vpn['rates'][0])
+                item['stats']['rateout'] = format_rate(vpn['rates'][1])
+            current = vpn['sessions'].index() if vpn.get('sessions') else {}
+            old = {}
+            if previous is not None and previous.vpns.get(key, {}).get('sessions'):
+                old = previous.vpns[key]['sessions'].index()
+            # only counts, however many sessions there are: pages fetch the
+            # counters of the rows they show
+            changed = 0
+            added = 0
+            for skey, session in current.items():
+                # sessions are only copied when their counters change
+                old_session = old.get(skey)
+                if old_session is session:
+                    continue
+                if old_session is None:
+                    added += 1
+                else:
+                    changed += 1
+            item['changed'] = changed
+            item['added'] = added
+            item['removed'] = sum(1 for skey in old if skey not in current)
+        return {'generation': snapshot.generation, 'timestamp': int(snapshot.timestamp),
+                'updated': datetime.fromtimestamp(snapshot.timestamp).strftime(
+                    '%a %d/%m/%Y %H:%M:%S'),
+                'vpns': vpns}
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class OpenvpnApi(object):
+    """JSON view of the VPNs, answering (status, headers, body) for a request.
+
+    Responses from a snapshot carry an ETag derived from its generation, so
+    pollers get a 304 until the collector writes a new one.
+    """
+
+    max_limit = 10000
+
+    def __init__(self, monitor):
+        self.vpns = monitor.vpns
+        self.timestamp = monitor.timestamp
+        self.etag = None
+        generation = getattr(monitor, 'generation', None)
+        if generation is not None:
+            self.etag = self.make_etag(generation, self.timestamp)
+
+    @staticmethod
+    def make_etag(generation, timestamp):
+        return '"{0!s}-{1!s}"'.format(generation, int(timestamp))
+
+    @staticmethod
+    def matches(etag, if_none_match):
+        return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    @classmethod
+    def check_path(cls, path, vpns):
+        """Return the error response for a path naming no resource, or None."""
+        parts = [part for part in path.split('/') if part]
+        if parts[:2] != ['api', 'vpns'] or len(parts) not in (2, 4) or \
+                (len(parts) == 4 and parts[3] not in ('sessions', 'counters')):
+            return cls.error('404 Not Found', 'No such resource')
+        if len(parts) == 4 and unquote(parts[2]) not in vpns:
+            return cls.error('404 Not Found', 'No VPN named {0!s}'.format(unquote(parts[2])))
+        return None
+
+    def respond(self, path, query='', if_none_match=None, accept_encoding=''):
+        # only resources that exist can be unchanged
+        error = self.check_path(path, self.vpns)
+        if error is not None:
+            return error
+        if self.etag is not None and if_none_match is not None and \
+                self.matches(self.etag, if_none_match):
+            return '304 Not Modified', [('ETag', self.etag)], b''
+        parts = [part for part in path.split('/') if part]
+        params = parse_qs(query)
+        if len(parts) == 2:
+            document = self.vpn_list()
+        else:
+            key = unquote(parts[2])
+            try:
+                if parts[3] == 'counters':
+                    document = self.session_counters(key, params)
+                else:
+                    document = self.session_list(key, params)
+            except ValueError as e:
+                return self.error('400 Bad Request', e)
+        return self.encode('200 OK', document, accept_encoding)
+
+    def vpn_list(self):
+        vpns = []
+        for key, vpn in self.vpns.items():
+            item = {'key': key, 'name': vpn.get('name', key),
+                    'connected': bool(vpn.get('socket_connected'))}
+            if not item['connected']:
+                item['error'] = vpn.get('error', 'Connection refused')
+            elif 'site' in vpn:
+                item.update({'url': vpn['url'], 'stale': bool(vpn.get('stale')),
+                             'timestamp': vpn['site']['timestamp'],
+                             'vpns': vpn['site']['vpns']})
             else:
-                full_location = country
-            flag = 'flags/{0!s}.png'.format(session['location'].lower())
-            print('<td><img src="{0!s}" title="{1!s}" alt="{1!s}" /> '.format(flag, full_location))
-            print('{0!s}</td>'.format(full_location))
+                state = vpn['state']
+                item.update({
+                    'mode': state['mode'],
+                    'state': state['connected'],
+                    'success': state['success'],
+                    'version': vpn['version'],
+                    'up_since': int(time.mktime(state['up_since'].timetuple())),
+                    'local_ip': str(state['local_ip']),
+                    'remote_ip': str(state['remote_ip']),
+                    'nclients': vpn['stats']['nclients'],
+                    'bytesin': vpn['stats']['bytesin'],
+                    'bytesout': vpn['stats']['bytesout'],
+                    'sessions': len(vpn['sessions'].index()),
+                })
+                if 'rates' in vpn:
+                    item['rates'] = list(vpn['rates'])
+                if 'collected' in vpn:
+                    item['collected'] = int(vpn['collected'])
+                if vpn.get('stale'):
+                    # the totals are from the last poll that succeeded
+                    item.update({'stale': True, 'error': vpn['error']})
+            vpns.append(item)
+        return {'timestamp': int(self.timestamp), 'vpns': vpns}
+
+    def session_list(self, key, params):
+        vpn = self.vpns[key]
+        sessions = []
+        if vpn.get('sessions'):
+            sessions = sorted(vpn['sessions'].index().values(),
+                              key=lambda session: session._connected_since)
+        username = params.get('username', [None])[0]
+        if username is not None:
+            sessions = [s for s in sessions if s.username == username]
+        country = params.get('country', [None])[0]
+        if country is not None:
+            country = country.lower()
+            sessions = [s for s in sessions if s.location.lower() == country or
+                        (s.country_name or '').lower() == country]
+        try:
+            offset = int(params.get('offset', [0])[0])
+            limit = int(params.get('limit', [100])[0])
+        except ValueError:
+            raise ValueError('offset and limit must be integers')
+        if offset < 0:
+            raise ValueError('offset must be >= 0')
+        if not 0 < limit <= self.max_limit:
+            raise ValueError('limit must be between 1 and {0!s}'.format(self.max_limit))
+        return {'timestamp': int(self.timestamp), 'vpn': key, 'total': len(sessions),
+                'offset': offset, 'limit': limit,
+                'sessions': [s.as_dict() for s in sessions[offset:offset + limit]]}
+
+    def session_counters(self, key, params):
+        """Return the formatted counters of the sessions with the given ids.
+
+        Live pages ask for the rows they show; ids of sessions that are gone
+        are left out.
+        """
+        vpn = self.vpns[key]
+        ids = [ident for ident in params.get('ids', [''])[0].split(',') if ident]
+        if len(ids) > self.max_limit:
+            raise ValueError('at most {0!s} ids'.format(self.max_limit))
+        counters = {}
+        if vpn.get('sessions'):
+            index = vpn.get('session_index')
+            if index is None:
+                index = vpn['session_index'] = SessionIndex(vpn['sessions'])
+            by_id = index.by_id()
+            for ident in ids:
+                session = by_id.get(ident)
+                if session is not None:
+                    counters[ident] = format_counters(session)
+        return {'timestamp': int(self.timestamp), 'vpn': key, 'counters': counters}
+
+    @staticmethod
+    def error(status, message):
+        body = json.dumps({'error': '{0!s}'.format(message)}).encode('utf-8')
+        return status, [('Content-Type', 'application/json')], body
+
+    def encode(self, status, document, accept_encoding):
+        body = json.dumps(document, separators=(',', ':')).encode('utf-8')
+        headers = [('Content-Type', 'application/json'), ('Vary', 'Accept-Encoding')]
+        if self.etag is not None:
+            headers.append(('ETag', self.etag))
+            headers.append(('Cache-Control', 'no-cache'))
+        if 'gzip' in accept_encoding and len(body) > 1024:
+            body = gzip_compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        return status, headers, body
+
+
+class OpenvpnHistoryApi(OpenvpnApi):
+    """JSON view of the traffic history, under /api/history/<vpn>[/<user>].
+
+    Buckets close every minute, so its answers carry no ETag either.
+    """
+
+    hour = 3600
+
+    def __init__(self, history, vpns):
+        self.history = history
+        self.vpns = vpns
+        self.etag = None
+
+    def respond(self, path, query='', accept_encoding=''):
+        parts = [unquote(part) for part in path.split('/') if part]
+        if parts[:2] != ['api', 'history'] or len(parts) not in (3, 4):
+            return self.error('404 Not Found', 'No such resource')
+        key = parts[2]
+        if key not in self.vpns:
+            return self.error('404 Not Found', 'No VPN named {0!s}'.format(key))
+        if self.history is None:
+            return self.error('404 Not Found', 'No traffic history available')
+        if len(parts) == 4 and self.history.db is None:
+            return self.error('404 Not Found', 'Traffic per user needs history to be set')
+        try:
+            start, end, resolution = self.range(parse_qs(query))
+        except ValueError as e:
+            return self.error('400 Bad Request', e)
+        document = {'vpn': key, 'start': start, 'end': end, 'resolution': resolution}
+        if len(parts) == 4:
+            series = 'user:{0!s}:{1!s}'.format(key, parts[3])
+            document['user'] = parts[3]
         else:
-            print('<td>{0!s}</td>'.format(session['location']))
-
-        print('<td>{0!s} ({1!s})</td>'.format(bytes_recv, naturalsize(bytes_recv, binary=True)))
-        print('<td>{0!s} ({1!s})</td>'.format(bytes_sent, naturalsize(bytes_sent, binary=True)))
-        print('<td>{0!s}</td>'.format(
-            session['connected_since'].strftime('%d/%m/%Y %H:%M:%S')))
-        if 'last_seen' in session:
-            print('<td>{0!s}</td>'.format(
-                session['last_seen'].strftime('%d/%m/%Y %H:%M:%S')))
+            series = 'vpn:' + key
+        # bytes per second in and out of every bucket from start to end
+        document['traffic'] = [list(row) for row in
+                               self.history.query(series, start, end, resolution)]
+        return self.encode('200 OK', document, accept_encoding)
+
+    def range(self, params):
+        try:
+            end = int(params.get('end', [time.time()])[0])
+            start = int(params.get('start', [end - self.hour])[0])
+            resolution = int(params.get('resolution', [TrafficHistory.tiers[0][0]])[0])
+        except ValueError:
+            raise ValueError('start, end and resolution must be integers')
+        resolutions = [tier[0] for tier in TrafficHistory.tiers]
+        if resolution not in resolutions:
+            raise ValueError('resolution must be one of {0!s}'.format(
+                ', '.join('{0!s}'.format(r) for r in resolutions)))
+        return start, end, resolution
+
+
+class OpenvpnLogApi(OpenvpnApi):
+    """JSON view of the session log, under /api/log/.
+
+    The log changes with every disconnect, so its answers carry no ETag.
+    """
+
+    week = 7 * 24 * 3600
+
+    def __init__(self, session_log):
+        self.session_log = session_log
+        self.etag = None
+
+    def respond(self, path, query='', accept_encoding=''):
+        parts = [part for part in path.split('/') if part]
+        if parts[:2] != ['api', 'log'] or len(parts) != 3 or \
+                parts[2] not in ('sessions', 'top'):
+            return self.error('404 Not Found', 'No such resource')
+        if self.session_log is None:
+            return self.error('404 Not Found', 'No session log available')
+        params = parse_qs(query)
+        try:
+            if parts[2] == 'sessions':
+                document = self.sessions(params)
+            else:
+                document = self.top(params)
+        except ValueError as e:
+            return self.error('400 Bad Request', e)
+        return self.encode('200 OK', document, accept_encoding)
+
+    def range(self, params, start, limit):
+        try:
+            end = int(params.get('end', [time.time()])[0])
+            start = int(params.get('start', [start])[0])
+            limit = int(params.get('limit', [limit])[0])
+        except ValueError:
+            raise ValueError('start, end and limit must be integers')
+        if not 0 < limit <= self.max_limit:
+            raise ValueError('limit must be between 1 and {0!s}'.format(self.max_limit))
+        return start, end, limit
+
+    def sessions(self, params):
+        start, end, limit = self.range(params, 0, 100)
+        username = params.get('username', [None])[0]
+        country = params.get('country', [None])[0]
+        return {'start': start, 'end': end, 'limit': limit,
+                'sessions': self.session_log.sessions(username, country, start, end, limit)}
+
+    def top(self, params):
+        start, end, limit = self.range(params, time.time() - self.week, 10)
+        return {'start': start, 'end': end, 'limit': limit,
+                'users': self.session_log.top_talkers(start, end, limit)}
+
+
+def write_cgi_response(status, headers, body):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    lines = ['Status: {0!s}'.format(status)]
+    lines.extend('{0!s}: {1!s}'.format(name, value) for name, value in headers)
+    out.write(('\n'.join(lines) + '\n\n').encode('utf-8'))
+    out.write(body)
+    out.flush()
+
+
+class OpenvpnRequestHandler(object):
+    """Answers the requests of --serve, on top of BaseHTTPRequestHandler.
+
+    serve() puts the two together, so that http.server is only imported
+    in that mode.
+    """
+
+    server_version = 'openvpn-monitor'
+    keepalive = 15
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.startswith('/flags/'):
+            self.send_flag(path[len('/flags/'):])
+            return
+        if path == '/events':
+            self.send_events(query)
+            return
+        if path.startswith('/api/log/'):
+            self.send(*OpenvpnLogApi(self.server.collector.session_log).respond(
+                path, query, self.headers.get('Accept-Encoding', '')))
+            return
+        if path.startswith('/api/history/'):
+            self.send(*OpenvpnHistoryApi(self.server.collector.history,
+                                         self.server.cfg.vpns).respond(
+                path, query, self.headers.get('Accept-Encoding', '')))
+            return
+        snapshot = self.server.collector.snapshot
+        if snapshot is None:
+            self.send('503 Service Unavailable', [('Content-Type', 'text/plain')],
+                      b'No data collected yet\n')
+        elif path == '/stats' and timings:
+            stats = {'timings': [dict(zip(('vpn', 'phase', 'count', 'min', 'avg', 'p95'), row))
+                                 for row in timings.report()]}
+            if geoip_resolver is not None:
+                stats['geoip'] = geoip_resolver.stats()
+            self.send('200 OK', [('Content-Type', 'application/json')],
+                      json.dumps(stats).encode('utf-8'))
+        elif path == '/metrics':
+            body = OpenvpnMetricsPrinter(self.server.cfg, snapshot).render()
+            self.send('200 OK', [('Content-Type', OpenvpnMetricsPrinter.content_type)],
+                      body.encode('utf-8'))
+        elif path.startswith('/api/'):
+            self.send(*OpenvpnApi(snapshot).respond(
+                path, query, self.headers.get('If-None-Match'),
+                self.headers.get('Accept-Encoding', '')))
+        elif path in ('/', '/index.html'):
+            body = OpenvpnHtmlPrinter(self.server.cfg, snapshot, query,
+                                      live=True).html().encode('utf-8')
+            headers = [('Content-Type', 'text/html; charset=utf-8'),
+                       ('Vary', 'Accept-Encoding')]
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip_compress(body)
+                headers.append(('Content-Encoding', 'gzip'))
+            self.send('200 OK', headers, body)
         else:
-            print('<td>ERROR</td>')
-        print('<td>{0!s}</td>'.format(total_time))
+            self.send('404 Not Found', [('Content-Type', 'text/plain')], b'Not found\n')
 
-    def print_session_table(self, vpn_mode, sessions):
-        for key, session in list(sessions.items()):
-            print('<tr>')
-            if vpn_mode == 'Client':
-                self.print_client_session(session)
-            elif vpn_mode == 'Server':
-                self.print_server_session(session)
-            print('</tr>')
+    def send_events(self, query):
+        live = self.server.live
+        since = self.headers.get('Last-Event-ID') or parse_qs(query).get('since', [''])[0]
+        try:
+            generation = int(since)
+        except ValueError:
+            generation = live.generation
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        try:
+            while True:
+                updates = live.since(generation, self.keepalive)
+                if updates is None:
+                    self.wfile.write(b'event: reload\ndata: {}\n\n')
+                    return
+                if not updates:
+                    # also notices browsers that went away
+                    self.wfile.write(b': keepalive\n\n')
+                for generation, update in updates:
+                    self.wfile.write('id: {0!s}\ndata: {1!s}\n\n'.format(
+                        generation, update).encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, socket.error):
+            return
+
+    def send_flag(self, name):
+        flag = self.server.flag(name)
+        if flag is None:
+            self.send('404 Not Found', [('Content-Type', 'text/plain')], b'Not found\n')
+            return
+        body, modified = flag
+        headers = [('Last-Modified', modified), ('Cache-Control', 'public, max-age=604800')]
+        if self.headers.get('If-Modified-Since') == modified:
+            self.send('304 Not Modified', headers, b'')
+        else:
+            self.send('200 OK', [('Content-Type', 'image/png')] + headers, body)
 
-    @staticmethod
-    def print_maps_header():
-        print('<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/leaflet/0.7.7/leaflet.css" />')
-        print('<script src="//cdnjs.cloudflare.com/ajax/libs/leaflet/0.7.7/leaflet.js"></script>')
+    def send(self, status, headers, body):
+        code, _, message = status.partition(' ')
+        self.send_response(int(code), message)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
-    def print_maps_html(self):
-        print('<div class="panel panel-info"><div class="panel-heading">')
-        print('<h3 class="panel-title">Map View</h3></div><div class="panel-body">')
-        print('<div id="map_canvas" style="height:500px"></div>')
-        print('<script type="text/javascript">')
-        print('var map = L.map("map_canvas");')
-        print('var centre = L.latLng({0!s}, {1!s});'.format(self.latitude, self.longitude))
-        print('map.setView(centre, 8);')
-        print('url = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png";')
-        print('var layer = new L.TileLayer(url, {});')
-        print('map.addLayer(layer);')
-        print('var bounds = L.latLngBounds(centre);')
-        for vkey, vpn in self.vpns:
-            if 'sessions' in vpn:
-                print('bounds.extend(centre);')
-                for skey, session in list(vpn['sessions'].items()):
-                    if 'longitude' in session and 'latitude' in session:
-                        print('var latlng = new L.latLng({0!s}, {1!s});'.format(
-                            session['latitude'], session['longitude']))
-                        print('bounds.extend(latlng);')
-                        print('var marker = L.marker(latlng).addTo(map);')
-                        print('var popup = L.popup().setLatLng(latlng);')
-                        print('popup.setContent("{0!s} - {1!s}");'.format(
-                            session['username'], session['remote_ip']))
-                        print('marker.bindPopup(popup);')
-        print('map.fitBounds(bounds);')
-        print('</script>')
-        print('</div></div>')
+    do_HEAD = do_GET
 
-    @staticmethod
-    def print_html_footer():
-        print('<div class="well well-sm">')
-        print('Page automatically reloads every 5 minutes.')
-        print('Last update: <b>{0!s}</b></div>'.format(
-            datetime.now().strftime('%a %d/%m/%Y %H:%M:%S')))
-        print('</div></body></html>')
+    def log_message(self, format, *arguments):
+        if args.debug:
+            debug('=== {0!s} {1!s}'.format(self.address_string(), format % arguments))
+
+
+class OpenvpnHttpServer(object):
+    """Serves the page, flags, metrics and API from the collector's snapshot.
+
+    Every request is handled in its own thread and only reads the latest
+    snapshot in memory; the collector runs in a background thread. Like the
+    request handler, it is combined with a threading HTTPServer by serve().
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    flags_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flags')
+    flag_name = re.compile(r'^[a-z.]+\.png$')
+
+    def __init__(self, address, handler, cfg, collector):
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        super(OpenvpnHttpServer, self).__init__(address, handler)
+        self.cfg = cfg
+        self.collector = collector
+        self.flags = {}
+        self.live = LiveUpdates()
+        collector.snapshot_listeners.append(self.live.publish)
+
+    def flag(self, name):
+        """Return (image, last modified) of a flag, read once, or None."""
+        if not self.flag_name.match(name):
+            return None
+        flag = self.flags.get(name)
+        if flag is None:
+            path = os.path.join(self.flags_path, name)
+            from email.utils import formatdate
+            try:
+                with open(path, 'rb') as f:
+                    flag = (f.read(), formatdate(os.path.getmtime(path), usegmt=True))
+            except (IOError, OSError):
+                return None
+            self.flags[name] = flag
+        return flag
+
+
+def serve(cfg, address):
+    host, _, port = address.rpartition(':')
+    try:
+        address = (host.strip('[]'), int(port))
+    except ValueError:
+        sys.exit('--serve expects host:port, not {0!s}'.format(address))
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    handler = type(str('RequestHandler'),
+                   (OpenvpnRequestHandler, BaseHTTPRequestHandler), {})
+    server_class = type(str('HttpServer'),
+                        (OpenvpnHttpServer, ThreadingMixIn, HTTPServer), {})
+    collector = OpenvpnCollector(cfg)
+    # the server listens to the collector, so /events sees every snapshot
+    server = server_class(address, handler, cfg, collector)
+    thread = threading.Thread(target=collector.run)
+    thread.daemon = True
+    thread.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 def main():
-    cfg = ConfigLoader(args.config)
-    monitor = OpenvpnMonitor(cfg.vpns)
-    OpenvpnHtmlPrinter(cfg, monitor)
+    global timings
+    if args.profile:
+        timings = Timings()
+    profiler = None
+    if args.profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(ConfigLoader(args.config))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_output)
+        if timings is not None:
+            sys.stderr.write(timings.format())
+
+
+def run(cfg):
+    if args.collect:
+        if 'snapshot' not in cfg.settings:
+            sys.exit('--collect requires snapshot to be set in the config file')
+        OpenvpnCollector(cfg).run()
+        return
+    if args.serve:
+        serve(cfg, args.serve)
+        return
+    if os.environ.get('PATH_INFO') == '/metrics':
+        # scrapes are only served from the collector's snapshot
+        monitor = None
+        if 'snapshot' in cfg.settings:
+            monitor = Snapshot.load(cfg.settings['snapshot'])
+        if monitor is None:
+            print('Status: 503 Service Unavailable')
+            print('Content-Type: text/plain\n')
+            print('No snapshot available')
+            return
+        print('Content-Type: {0!s}\n'.format(OpenvpnMetricsPrinter.content_type))
+        sys.stdout.write(OpenvpnMetricsPrinter(cfg, monitor).render())
+        return
+    path = os.environ.get('PATH_INFO', '')
+    if path.startswith('/api/log/'):
+        # the session log is read by itself, without the VPNs
+        session_log = None
+        if os.path.exists(cfg.settings.get('session_log') or ''):
+            session_log = SessionLog(cfg.settings['session_log'], readonly=True)
+        write_cgi_response(*OpenvpnLogApi(session_log).respond(
+            path, os.environ.get('QUERY_STRING', ''),
+            os.environ.get('HTTP_ACCEPT_ENCODING', '')))
+        if session_log is not None:
+            session_log.close()
+        return
+    if path.startswith('/api/history/'):
+        # read from the collector's database, which is never created here
+        history = None
+        if os.path.exists(cfg.settings.get('history') or ''):
+            history = TrafficHistory(cfg.settings['history'], readonly=True)
+        write_cgi_response(*OpenvpnHistoryApi(history, cfg.vpns).respond(
+            path, os.environ.get('QUERY_STRING', ''),
+            os.environ.get('HTTP_ACCEPT_ENCODING', '')))
+        if history is not None:
+            history.close()
+        return
+    if_none_match = os.environ.get('HTTP_IF_NONE_MATCH')
+    if path.startswith('/api/') and if_none_match and 'snapshot' in cfg.settings and \
+            OpenvpnApi.check_path(path, cfg.vpns) is None:
+        # answer unchanged pollers without unpickling the whole snapshot
+        header = Snapshot.peek(cfg.settings['snapshot'])
+        if header is not None:
+            etag = OpenvpnApi.make_etag(*header)
+            if OpenvpnApi.matches(etag, if_none_match):
+                write_cgi_response('304 Not Modified', [('ETag', etag)], b'')
+                return
+    monitor = None
+    if 'snapshot' in cfg.settings:
+        monitor = Snapshot.load(cfg.settings['snapshot'])
+    if monitor is None:
+        monitor = OpenvpnMonitor(cfg.vpns, cfg.settings)
+    if path.startswith('/api/'):
+        write_cgi_response(*OpenvpnApi(monitor).respond(
+            path, os.environ.get('QUERY_STRING', ''),
+            if_none_match, os.environ.get('HTTP_ACCEPT_ENCODING', '')))
+        return
+    printer = OpenvpnHtmlPrinter(cfg, monitor, os.environ.get('QUERY_STRING', ''))
+    print('Content-Type: text/html\n')
+    sys.stdout.write(printer.html())
     if args.debug:
+        from pprint import pformat
         pretty_vpns = pformat((dict(monitor.vpns)))
         debug("=== begin vpns\n{0!s}\n=== end vpns".format(pretty_vpns))
+        if geoip_resolver is not None:
+            debug("=== geoip cache {0!s}".format(geoip_resolver.stats()))
 
 
 def collect_args():
@@ -651,6 +3549,21 @@ def collect_args():
                         required=False,
                         default='/usr/share/GeoIP/GeoIPCity.dat',
                         help='Path to GeoIPCity.dat')
+    parser.add_argument('--collect', action='store_true',
+                        required=False, default=False,
+                        help='Run as a collector, writing snapshots to the '
+                             'snapshot path from the config file')
+    parser.add_argument('--profile', action='store_true',
+                        required=False, default=False,
+                        help='Time collection, parsing, GeoIP and rendering and '
+                             'print min/avg/p95 per VPN to stderr on exit')
+    parser.add_argument('--profile-output', type=str, metavar='PATH',
+                        required=False, default=None,
+                        help='Write cProfile statistics to PATH on exit')
+    parser.add_argument('--serve', type=str, metavar='HOST:PORT',
+                        required=False, default=None,
+                        help='Run a collector and serve the page, metrics and '
+                             'API over HTTP on HOST:PORT')
     return parser
 
 
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+"""Loads openvpn-monitor.py and openvpn-monitor-bench.py, whose names are
+not valid module names, once for all the tests."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+
+def load_script(name, module_name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(module_name, path)
+    spec = spec_from_file_location(module_name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bench = load_script('openvpn-monitor-bench.py', 'openvpn_monitor_bench')
+monitor = bench.load_monitor()
+monitor.args = monitor.collect_args().parse_args([])
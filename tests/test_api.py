@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from support import bench, monitor
+
+
+class OpenvpnApiTest(unittest.TestCase):
+
+    def setUp(self):
+        sessions = monitor.OpenvpnMonitor.parse_status(bench.status3_dump(3).splitlines())
+        for session in sessions.sessions():
+            session._geo = monitor.UNKNOWN_LOCATION
+        state = monitor.OpenvpnMonitor.parse_state('1470000000,CONNECTED,SUCCESS,10.8.0.1,,,,')
+        stats = {'nclients': 3, 'bytesin': 1024, 'bytesout': 2048}
+        self.snapshot = monitor.Snapshot(
+            {'VPN1': {'name': 'Staff VPN', 'socket_connected': True, 'state': state,
+                      'stats': stats, 'sessions': sessions, 'version': 'OpenVPN 2.4.0'}},
+            generation=7, timestamp=1470000000)
+        self.api = monitor.OpenvpnApi(self.snapshot)
+
+    def error(self, response):
+        return json.loads(response[2].decode('utf-8'))['error']
+
+    def test_unchanged_resources(self):
+        etag = self.api.etag
+        for path in ('/api/vpns', '/api/vpns/VPN1/sessions'):
+            status, headers, body = self.api.respond(path, if_none_match=etag)
+            self.assertEqual(status, '304 Not Modified')
+            self.assertEqual(body, b'')
+
+    def test_unknown_resources_are_not_unchanged(self):
+        etag = self.api.etag
+        for path in ('/api/vpns/VPN2/sessions', '/api/vpns/VPN1/other', '/api/other'):
+            response = self.api.respond(path, if_none_match=etag)
+            self.assertEqual(response[0], '404 Not Found')
+        self.assertEqual(self.error(self.api.respond('/api/vpns/VPN2/sessions')),
+                         'No VPN named VPN2')
+
+    def test_paging_errors_name_their_parameter(self):
+        response = self.api.respond('/api/vpns/VPN1/sessions', 'offset=-1')
+        self.assertEqual(response[0], '400 Bad Request')
+        self.assertEqual(self.error(response), 'offset must be >= 0')
+        response = self.api.respond('/api/vpns/VPN1/sessions', 'limit=0')
+        self.assertEqual(self.error(response), 'limit must be between 1 and 10000')
+
+    def test_sessions_page(self):
+        status, headers, body = self.api.respond('/api/vpns/VPN1/sessions', 'offset=1&limit=1')
+        document = json.loads(body.decode('utf-8'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual((document['total'], len(document['sessions'])), (3, 1))
+        self.assertEqual(document['sessions'][0]['username'], 'client1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+import unittest
+
+from support import bench, monitor
+
+
+def snapshot(generation, sessions):
+    state = monitor.OpenvpnMonitor.parse_state('1470000000,CONNECTED,SUCCESS,10.8.0.1,,,,')
+    stats = {'nclients': len(sessions), 'bytesin': 1024, 'bytesout': 2048}
+    return monitor.Snapshot({'VPN1': {'name': 'Staff VPN', 'socket_connected': True,
+                                      'state': state, 'stats': stats,
+                                      'sessions': sessions}}, generation)
+
+
+class LiveUpdatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = monitor.OpenvpnMonitor.parse_status(
+            bench.status3_dump(100).splitlines())
+
+    def test_diff_only_counts_sessions(self):
+        sessions = monitor.VpnStatus(self.sessions)
+        for ident in ('10.0.0.1', '10.0.0.2'):
+            sessions[ident] = sessions[ident].copy()
+            sessions[ident].bytes_recv += 1
+        del sessions['10.0.0.3']
+        update = monitor.LiveUpdates.diff(snapshot(1, self.sessions), snapshot(2, sessions))
+        vpn = update['vpns']['VPN1']
+        self.assertEqual((vpn['changed'], vpn['added'], vpn['removed']), (2, 0, 1))
+        self.assertEqual(update['generation'], 2)
+
+    def test_counters_of_the_rows_shown(self):
+        sessions = monitor.VpnStatus(self.sessions)
+        del sessions['10.0.0.3']
+        ids = [monitor.session_id(self.sessions[ident])
+               for ident in ('10.0.0.1', '10.0.0.3')]
+        status, headers, body = monitor.OpenvpnApi(snapshot(2, sessions)).respond(
+            '/api/vpns/VPN1/counters', 'ids=' + ','.join(ids))
+        self.assertEqual(status, '200 OK')
+        counters = json.loads(body.decode('utf-8'))['counters']
+        self.assertEqual(list(counters), ids[:1])
+        self.assertEqual(counters[ids[0]][0], monitor.format_bytes(1024))
+
+    def test_waits_before_the_first_snapshot(self):
+        live = monitor.LiveUpdates()
+        started = time.time()
+        self.assertEqual(live.since(50, 0.2), [])
+        self.assertTrue(time.time() - started >= 0.2)
+        # a browser from before a restart reloads once there is a snapshot
+        timer = threading.Timer(0.1, live.publish, (None, snapshot(1, self.sessions)))
+        timer.start()
+        self.assertIsNone(live.since(50, 5))
+        timer.join()
+
+    def test_catches_up_from_the_last_event(self):
+        live = monitor.LiveUpdates()
+        live.publish(None, snapshot(1, self.sessions))
+        live.publish(snapshot(1, self.sessions), snapshot(2, self.sessions))
+        self.assertEqual([generation for generation, update in live.since(0, 0)], [1, 2])
+        self.assertEqual([generation for generation, update in live.since(1, 0)], [2])
+        self.assertEqual(live.since(2, 0.01), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from support import bench, monitor
+
+# replies are written this many bytes at a time, so that END, CRLF and
+# notifications end up split across reads in every possible place
+CHUNK_SIZES = range(1, 8)
+NSESSIONS = 5
+
+
+class ManagementSessionTest(unittest.TestCase):
+
+    def connect(self, chunk_size, replies=None):
+        server = bench.FakeManagementServer(NSESSIONS, chunk_size=chunk_size)
+        server.replies.update(replies or {})
+        server.start()
+        self.addCleanup(server.close)
+        session = monitor.ManagementSession('127.0.0.1', server.port, timeout=5)
+        session.connect()
+        self.addCleanup(session.disconnect)
+        return server, session
+
+    def assert_status(self, lines):
+        sessions = monitor.OpenvpnMonitor.parse_status(lines)
+        self.assertEqual(sorted(s.username for s in sessions.sessions()),
+                         ['client{0!s}'.format(i) for i in range(NSESSIONS)])
+
+    def test_replies_split_across_reads(self):
+        for chunk_size in CHUNK_SIZES:
+            server, session = self.connect(chunk_size)
+            self.assertEqual(session.send_command('version\n'),
+                             server.replies['version'].decode('utf-8'))
+            self.assertEqual(session.send_command('load-stats\n'),
+                             server.replies['load-stats'].decode('utf-8'))
+            self.assertEqual(session.send_command('state\n'),
+                             server.replies['state'].decode('utf-8'))
+            self.assert_status(session.send_command('status 3\n', stream=True))
+            # the stream is left at the start of the next reply
+            self.assertEqual(session.send_command('pid\n'), 'SUCCESS: pid=1\r\n')
+            self.assertEqual(session.notifications[0][:5], '>INFO')
+
+    def test_notifications_inside_replies(self):
+        status = bench.status3_dump(NSESSIONS).split('\r\n')
+        status.insert(3, '>BYTECOUNT_CLI:1,100,200')
+        status.insert(0, '>INFO:a notification ahead of the reply')
+        status = '\r\n'.join(status).encode('utf-8')
+        version = b'>CLIENT:ENV,END\r\n' + bench.FakeManagementServer(0).replies['version']
+        for chunk_size in CHUNK_SIZES:
+            server, session = self.connect(chunk_size, {'status 3': status,
+                                                        'version': version})
+            reply = session.send_command('version\n')
+            self.assertTrue(reply.startswith('OpenVPN Version'))
+            self.assert_status(session.send_command('status 3\n', stream=True))
+            reply = session.send_command('status 3\n')
+            self.assertNotIn('>', reply)
+            self.assert_status(reply)
+            self.assertEqual(session.notifications[1:], [
+                '>CLIENT:ENV,END',
+                '>INFO:a notification ahead of the reply',
+                '>INFO:a notification ahead of the reply'])
+            self.assertEqual(session.bytecounts, {'1': '>BYTECOUNT_CLI:1,100,200'})
+
+    def test_only_the_latest_byte_count_is_kept(self):
+        session = monitor.ManagementSession('127.0.0.1', 0)
+        for line in ['>BYTECOUNT_CLI:1,10,20', '>CLIENT:ESTABLISHED,2,0',
+                     '>BYTECOUNT_CLI:2,1,2', '>CLIENT:ENV,END', '>BYTECOUNT_CLI:1,30,40']:
+            session._notify(line)
+        self.assertEqual(session.notifications, ['>CLIENT:ESTABLISHED,2,0', '>CLIENT:ENV,END'])
+        self.assertEqual(sorted(session.bytecounts.values()),
+                         ['>BYTECOUNT_CLI:1,30,40', '>BYTECOUNT_CLI:2,1,2'])
+
+    def test_overflow_is_reported(self):
+        session = monitor.ManagementSession('127.0.0.1', 0)
+        session.max_notifications = 2
+        for i in range(1000):
+            session._notify('>BYTECOUNT_CLI:{0!s},1,2'.format(i % 10))
+        self.assertFalse(session.overflowed)
+        for line in ['>CLIENT:DISCONNECT,1', '>CLIENT:ENV,END', '>CLIENT:ESTABLISHED,2']:
+            session._notify(line)
+        self.assertTrue(session.overflowed)
+        self.assertEqual(len(session.bytecounts), 10)
+
+    def test_error_reply_to_multi_line_command(self):
+        for chunk_size in CHUNK_SIZES:
+            server, session = self.connect(chunk_size)
+            reply = session.send_command('status 9\n')
+            self.assertTrue(reply.startswith('ERROR: unknown command'))
+            lines = list(session.send_command('status 9\n', stream=True))
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith('ERROR: unknown command'))
+            self.assertEqual(session.send_command('pid\n'), 'SUCCESS: pid=1\r\n')
+
+    def test_pipelined_replies(self):
+        commands = ['version\n', 'status 9\n', 'state\n', 'load-stats\n', 'status 3\n']
+        for chunk_size in CHUNK_SIZES:
+            server, session = self.connect(chunk_size)
+            version, error, state, stats, status = session.send_commands(
+                commands, stream=True)
+            self.assertEqual(version, server.replies['version'].decode('utf-8'))
+            self.assertTrue(error.startswith('ERROR: unknown command'))
+            self.assertEqual(state, server.replies['state'].decode('utf-8'))
+            self.assertEqual(stats, server.replies['load-stats'].decode('utf-8'))
+            self.assert_status(status)
+            self.assertEqual(session.send_command('pid\n'), 'SUCCESS: pid=1\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from support import bench, monitor
+
+apply_notifications = monitor.OpenvpnMonitor.apply_notifications
+
+
+def established(client_id, **env):
+    lines = ['>CLIENT:ESTABLISHED,{0!s},0'.format(client_id)]
+    lines.extend('>CLIENT:ENV,{0!s}={1!s}'.format(name, value)
+                 for name, value in sorted(env.items()))
+    lines.append('>CLIENT:ENV,END')
+    return lines
+
+
+class ApplyNotificationsTest(unittest.TestCase):
+
+    def setUp(self):
+        # client<i> has VPN address 10.0.0.<i> and client id <i>
+        self.sessions = monitor.OpenvpnMonitor.parse_status(
+            bench.status3_dump(3).splitlines())
+        self.state = monitor.OpenvpnMonitor.parse_state(
+            '1470000000,CONNECTED,SUCCESS,10.8.0.1,,,,\r\nEND')
+        self.before = dict((ident, (session.bytes_recv, session.bytes_sent))
+                           for ident, session in self.sessions.items())
+
+    def apply(self, notifications):
+        return apply_notifications(self.state, self.sessions, notifications)
+
+    def assert_unchanged(self):
+        # the sessions of the last poll are shared with readers of the snapshot
+        self.assertEqual(dict((ident, (session.bytes_recv, session.bytes_sent))
+                              for ident, session in self.sessions.items()),
+                         self.before)
+
+    def test_bytecount_copies_changed_sessions(self):
+        state, sessions = self.apply(['>BYTECOUNT_CLI:1,5000,6000'])
+        self.assertIsInstance(sessions, monitor.VpnStatus)
+        self.assertIsNot(sessions, self.sessions)
+        changed = sessions['10.0.0.1']
+        self.assertIsNot(changed, self.sessions['10.0.0.1'])
+        self.assertEqual((changed.bytes_recv, changed.bytes_sent), (5000, 6000))
+        self.assertEqual(changed.key, self.sessions['10.0.0.1'].key)
+        self.assertIs(sessions['10.0.0.0'], self.sessions['10.0.0.0'])
+        self.assertIs(sessions['10.0.0.2'], self.sessions['10.0.0.2'])
+        self.assert_unchanged()
+
+    def test_bytecount_copies_once(self):
+        state, sessions = self.apply(['>BYTECOUNT_CLI:1,5000,6000',
+                                      '>BYTECOUNT_CLI:1,7000,8000'])
+        self.assertEqual((sessions['10.0.0.1'].bytes_recv,
+                          sessions['10.0.0.1'].bytes_sent), (7000, 8000))
+        self.assert_unchanged()
+
+    def test_bytecount_ignores_older_and_unknown_counts(self):
+        state, sessions = self.apply(['>BYTECOUNT_CLI:2,0,0', '>BYTECOUNT_CLI:9,10,10'])
+        self.assertEqual(sessions, self.sessions)
+        self.assertIs(sessions['10.0.0.2'], self.sessions['10.0.0.2'])
+
+    def test_established_adds_a_session(self):
+        state, sessions = self.apply(established(
+            7, common_name='alice', trusted_ip='192.0.2.1', trusted_port=1194,
+            ifconfig_pool_remote_ip='10.0.0.9', time_unix=1470000100) +
+            ['>BYTECOUNT_CLI:7,100,200'])
+        session = sessions['10.0.0.9']
+        self.assertEqual(session.username, 'alice')
+        self.assertEqual(session.client_id, '7')
+        self.assertEqual(session.key, ('alice', '192.0.2.1:1194', 1470000100))
+        self.assertEqual(str(session.remote_ip), '192.0.2.1')
+        self.assertEqual(session.port, 1194)
+        self.assertEqual((session.bytes_recv, session.bytes_sent), (100, 200))
+        self.assertEqual(len(sessions), 4)
+        self.assertNotIn('10.0.0.9', self.sessions)
+
+    def test_established_for_a_known_session_keeps_its_counters(self):
+        known = self.sessions['10.0.0.2']
+        remote_ip, port = known.key[1].split(':')
+        # by client id, and by common name, real address and connected since
+        for client_id in ('2', '8'):
+            state, sessions = self.apply(established(
+                client_id, common_name='client2', trusted_ip=remote_ip,
+                trusted_port=port, ifconfig_pool_remote_ip='10.0.0.2',
+                time_unix=known.key[2]))
+            self.assertIs(sessions['10.0.0.2'], known)
+            self.assertEqual(len(sessions), 3)
+
+    def test_established_without_address_is_skipped(self):
+        state, sessions = self.apply(established(7, common_name='alice'))
+        self.assertEqual(sessions, self.sessions)
+
+    def test_disconnect_removes_the_session(self):
+        state, sessions = self.apply(['>CLIENT:DISCONNECT,0',
+                                      '>CLIENT:ENV,common_name=client0',
+                                      '>CLIENT:ENV,END',
+                                      '>BYTECOUNT_CLI:0,99999,99999'])
+        self.assertNotIn('10.0.0.0', sessions)
+        self.assertEqual(len(sessions), 2)
+        self.assertIn('10.0.0.0', self.sessions)
+        self.assert_unchanged()
+
+    def test_env_is_only_applied_at_end(self):
+        lines = established(7, common_name='alice', trusted_ip='192.0.2.1',
+                            trusted_port=1194, ifconfig_pool_remote_ip='10.0.0.9')
+        state, sessions = self.apply(lines[:-1])
+        self.assertNotIn('10.0.0.9', sessions)
+
+    def test_state_notification(self):
+        state, sessions = self.apply(['>STATE:1470000500,RECONNECTING,SUCCESS,10.8.0.1,,,,'])
+        self.assertEqual(state['connected'], 'RECONNECTING')
+        self.assertEqual(state['mode'], 'Server')
+        self.assertEqual(self.state['connected'], 'CONNECTED')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from support import bench, monitor
+
+Printer = monitor.OpenvpnHtmlPrinter
+
+
+class CellCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vpns = bench.synthetic_vpns(monitor, 5)
+        self.cfg = bench.Config({'maps': 'False', 'page_size': '2'})
+        Printer.cell_cache = {}
+        Printer.cell_cache_timestamp = None
+
+    def replace_sessions(self, sessions):
+        vpn = self.vpns['VPN1'] = dict(self.vpns['VPN1'], sessions=sessions)
+        # sort orders are built per collection
+        vpn.pop('session_index', None)
+
+    def render(self, timestamp, query=''):
+        return Printer(self.cfg, bench.Collected(self.vpns, timestamp), query).html()
+
+    def test_pages_do_not_evict_each_other(self):
+        self.render(1, 'vpn=VPN1&page=1')
+        self.render(1, 'vpn=VPN1&page=2')
+        self.assertEqual(len(Printer.cell_cache), 4)
+        self.render(1, 'vpn=VPN1&page=1')
+        self.assertEqual(len(Printer.cell_cache), 4)
+        self.assertTrue(all(isinstance(entry, tuple) for entry in Printer.cell_cache.values()))
+
+    def test_sessions_that_are_gone_are_pruned(self):
+        self.render(1, 'vpn=VPN1&page=3')
+        self.render(1, 'vpn=VPN1&page=1')
+        sessions = monitor.VpnStatus(self.vpns['VPN1']['sessions'])
+        gone = sessions.pop('10.0.0.4')
+        self.replace_sessions(sessions)
+        self.assertIn(gone.key, Printer.cell_cache)
+        self.render(2, 'vpn=VPN1&page=1')
+        self.assertNotIn(gone.key, Printer.cell_cache)
+        self.assertEqual(len(Printer.cell_cache), 2)
+
+    def test_changed_counters_replace_the_entry(self):
+        self.render(1, 'vpn=VPN1&page=1')
+        sessions = monitor.VpnStatus(self.vpns['VPN1']['sessions'])
+        session = sessions['10.0.0.0'] = sessions['10.0.0.0'].copy()
+        session.bytes_recv = 123456789
+        self.replace_sessions(sessions)
+        page = self.render(2, 'vpn=VPN1&page=1')
+        self.assertIn(monitor.format_bytes(123456789), page)
+        entry = Printer.cell_cache[session.key]
+        self.assertEqual(entry[2][0], 123456789)
+        self.assertIn(monitor.format_bytes(123456789), entry[3])
+
+
+class LazyGeoipTimingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vpns = bench.synthetic_vpns(monitor, 2)
+        for session in self.vpns['VPN1']['sessions'].sessions():
+            session._geo = None
+        self.cfg = bench.Config({'maps': 'False'})
+        Printer.cell_cache = {}
+        Printer.cell_cache_timestamp = None
+        monitor.geoip_resolver = monitor.GeoipResolver(None)
+        monitor.timings = monitor.Timings()
+
+    def tearDown(self):
+        monitor.geoip_resolver = None
+        monitor.timings = None
+
+    def test_lookups_are_charged_to_the_rendered_vpn(self):
+        Printer(self.cfg, bench.Collected(self.vpns, 1), 'vpn=VPN1').html()
+        name = self.vpns['VPN1']['name']
+        self.assertIn((name, 'geoip (lazy)'), monitor.timings.samples)
+        names = set(name for name, phase in monitor.timings.samples if phase == 'geoip (lazy)')
+        self.assertEqual(names, set([name]))
+
+
+if __name__ == '__main__':
+    unittest.main()
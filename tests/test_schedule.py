@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from support import monitor
+
+
+class PollScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = monitor.PollSchedule(
+            {'VPN1': {}, 'VPN2': {'interval': '10', 'max_interval': '30'}},
+            {'interval': '60', 'max_interval': '300', 'max_failures': '3'})
+
+    def waits(self, key, results, busy=True):
+        """Return the waits until the next poll after each result."""
+        waits = []
+        now = 1000
+        for success in results:
+            self.schedule.update(key, now, success, busy)
+            next_poll = self.schedule.entries[key][3]
+            waits.append(next_poll - now)
+            now = next_poll
+        return waits
+
+    def test_everything_is_due_at_first(self):
+        self.assertEqual(self.schedule.due(0), ['VPN1', 'VPN2'])
+        self.assertEqual(self.schedule.next_poll(), 0)
+
+    def test_section_overrides_intervals(self):
+        self.assertEqual(self.waits('VPN2', [True] * 4, busy=False), [20, 30, 30, 30])
+        schedule = monitor.PollSchedule({'VPN1': {}}, {'interval': '10'})
+        self.assertEqual(schedule.entries['VPN1'][1], 50)
+
+    def test_busy_vpn_keeps_its_interval(self):
+        self.assertEqual(self.waits('VPN1', [True] * 3), [60, 60, 60])
+
+    def test_idle_vpn_backs_off_until_traffic(self):
+        self.assertEqual(self.waits('VPN1', [True] * 5, busy=False),
+                         [120, 240, 300, 300, 300])
+        self.assertEqual(self.waits('VPN1', [True]), [60])
+
+    def test_circuit_opens_after_max_failures(self):
+        self.assertEqual(self.waits('VPN1', [False] * 2), [60, 60])
+        self.assertFalse(self.schedule.is_open('VPN1'))
+        self.assertEqual(self.waits('VPN1', [False] * 3), [120, 240, 300])
+        self.assertTrue(self.schedule.is_open('VPN1'))
+        self.assertEqual(self.waits('VPN1', [True]), [60])
+        self.assertFalse(self.schedule.is_open('VPN1'))
+
+    def test_only_due_vpns_are_polled(self):
+        self.schedule.update('VPN1', 1000, True)
+        self.schedule.update('VPN2', 1000, True)
+        self.assertEqual(self.schedule.due(1009), [])
+        self.assertEqual(self.schedule.next_poll(), 1010)
+        self.assertEqual(self.schedule.due(1010), ['VPN2'])
+        self.assertEqual(self.schedule.due(1060), ['VPN1', 'VPN2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under GPL v3
+# Copyright 2011 VPAC <http://www.vpac.org>
+# Copyright 2012-2016 Marcus Furlong <furlongm@gmail.com>
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+from support import monitor
+
+SessionLog = monitor.SessionLog
+DAY = 86400
+
+
+def utc(year, month, day):
+    return calendar.timegm((year, month, day, 0, 0, 0))
+
+
+def session(username, country='au', bytes_recv=100, bytes_sent=200):
+    session = monitor.Session(username, '192.0.2.1', 1194, bytes_recv, bytes_sent,
+                              1470000000, last_seen=1470000000)
+    session._geo = (country, 'Melbourne', 'Australia', 144.96, -37.81)
+    return session
+
+
+class SessionLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'sessions.db')
+        # queries end at the current time, which they leave out
+        self.now = time.time() - 60
+
+    def open(self, months=12):
+        log = SessionLog(self.path, months)
+        self.addCleanup(log.db.close)
+        return log
+
+    def test_partition_names(self):
+        self.assertEqual(SessionLog.partition(utc(2016, 8, 31) + DAY - 1), 'sessions_201608')
+        self.assertEqual(SessionLog.partition(utc(2016, 9, 1)), 'sessions_201609')
+        self.assertEqual(SessionLog.first_partition(utc(2016, 3, 15), 12), 'sessions_201504')
+        self.assertEqual(SessionLog.first_partition(utc(2016, 2, 1), 3), 'sessions_201512')
+        self.assertEqual(SessionLog.first_partition(utc(2016, 2, 1), 1), 'sessions_201602')
+
+    def test_only_disconnects_are_kept(self):
+        log = self.open()
+        log.event(self.now, 'connect', 'VPN1', session('alice'))
+        self.assertEqual(log.pending, [])
+        log.event(self.now, 'disconnect', 'VPN1', session('alice'))
+        self.assertEqual(len(log.pending), 1)
+        log.flush()
+        self.assertEqual(log.pending, [])
+        self.assertEqual(log.partitions(), [SessionLog.partition(self.now)])
+
+    def test_batches_are_written_when_full(self):
+        log = self.open()
+        log.batch_size = 3
+        for i in range(4):
+            log.event(self.now, 'disconnect', 'VPN1', session('user{0!s}'.format(i)))
+        self.assertEqual(len(log.pending), 1)
+        self.assertEqual(len(log.sessions()), 3)
+
+    def test_sessions_are_split_by_month_of_disconnection(self):
+        log = self.open()
+        earlier = self.now - 40 * DAY
+        log.event(earlier, 'disconnect', 'VPN1', session('alice', 'nz'))
+        log.event(self.now, 'disconnect', 'VPN1', session('alice'))
+        log.event(self.now - 1, 'disconnect', 'VPN2', session('bob'))
+        log.flush()
+        self.assertEqual(log.partitions(), sorted(set(
+            [SessionLog.partition(earlier), SessionLog.partition(self.now)])))
+        found = log.sessions(username='alice')
+        self.assertEqual([row['disconnected'] for row in found],
+                         [int(self.now), int(earlier)])
+        self.assertEqual(found[1]['country'], 'NZ')
+        self.assertEqual(found[0]['remote_ip'], '192.0.2.1')
+        self.assertEqual([row['username'] for row in log.sessions(country='au')],
+                         ['alice', 'bob'])
+        self.assertEqual(len(log.sessions(start=self.now - DAY)), 2)
+        self.assertEqual(len(log.sessions(end=self.now - DAY)), 1)
+        self.assertEqual(len(log.sessions(limit=1)), 1)
+        self.assertEqual(log.sessions(start=self.now + DAY), [])
+
+    def test_top_talkers(self):
+        log = self.open()
+        log.event(self.now, 'disconnect', 'VPN1', session('alice', bytes_recv=10))
+        log.event(self.now, 'disconnect', 'VPN1', session('alice', bytes_recv=10))
+        log.event(self.now, 'disconnect', 'VPN1', session('bob', bytes_recv=1000))
+        log.flush()
+        self.assertEqual(log.top_talkers(self.now - DAY), [
+            {'username': 'bob', 'sessions': 1, 'bytes_recv': 1000, 'bytes_sent': 200},
+            {'username': 'alice', 'sessions': 2, 'bytes_recv': 20, 'bytes_sent': 400}])
+        self.assertEqual(log.top_talkers(self.now - DAY, limit=1)[0]['username'], 'bob')
+
+    def test_old_months_are_dropped_with_a_new_month(self):
+        old = self.now - 150 * DAY
+        log = self.open()
+        log.event(old, 'disconnect', 'VPN1', session('alice'))
+        log.flush()
+        self.assertEqual(log.partitions(), [SessionLog.partition(old)])
+
+        log = self.open(months=2)
+        # sessions already past the retention are not stored at all
+        log.event(old, 'disconnect', 'VPN1', session('bob'))
+        log.flush()
+        self.assertEqual(log.partitions(), [SessionLog.partition(old)])
+        log.event(self.now, 'disconnect', 'VPN1', session('carol'))
+        log.flush()
+        self.assertEqual(log.partitions(), [SessionLog.partition(self.now)])
+        self.assertEqual([row['username'] for row in log.sessions()], ['carol'])
+
+    def test_readers_never_create_the_file(self):
+        status, headers, body = monitor.OpenvpnLogApi(None).respond('/api/log/sessions')
+        self.assertEqual(status, '404 Not Found')
+        if sys.version_info[0] > 2:
+            self.assertRaises(sqlite3.OperationalError, SessionLog, self.path, readonly=True)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_readers_cannot_write(self):
+        log = self.open()
+        log.event(self.now, 'disconnect', 'VPN1', session('alice'))
+        log.flush()
+        reader = SessionLog(self.path, readonly=True)
+        self.addCleanup(reader.db.close)
+        self.assertEqual([row['username'] for row in reader.sessions()], ['alice'])
+        if sys.version_info[0] > 2:
+            self.assertRaises(sqlite3.OperationalError, reader._create, 'sessions_200001')
+
+
+if __name__ == '__main__':
+    unittest.main()